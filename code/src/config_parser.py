@@ -1,6 +1,9 @@
+import copy
 import json
+import os
 import os.path as osp
 import logging
+from functools import lru_cache
 
 
 class Config:
@@ -37,7 +40,38 @@ def parse_config(config_path: str):
 
     with open(config_path, "r") as f:
         config_dict = json.loads(f.read())
+    return _make_config(config_dict)
+
+
+def _make_config(config_dict):
+    """
+    Wrap a parsed json config into a Config object, if it is a dictionary.
+    """
     if isinstance(config_dict, dict):
         return Config(config_dict)
     else:
         return config_dict
+
+
+@lru_cache(maxsize=32)
+def _load_config_at(config_path: str, mtime_ns: int):
+    """
+    Loads a json config file. Results are memoized on the path and the modification time of the file.
+    :param config_path: Path to the json config file.
+    :param mtime_ns: Modification time of the file. Used to invalidate the cache when the file changes.
+    """
+    with open(config_path, "r") as f:
+        return json.loads(f.read())
+
+
+def parse_config_cached(config_path: str):
+    """
+    Parses a json config file into a Config object, reusing the previously loaded json if the file is unchanged on disk.
+    Every call returns a new Config object, so callers can override settings without affecting each other.
+    :param config_path: Path to the json config file.
+    """
+    try:
+        mtime_ns = os.stat(config_path).st_mtime_ns
+    except OSError:
+        return parse_config(config_path)
+    return _make_config(copy.deepcopy(_load_config_at(config_path, mtime_ns)))
@@ -3,9 +3,7 @@ import logging
 import os
 import os.path as osp
 import random
-import numpy as np
-
-from config_parser import parse_config
+import sys
 
 
 class ConfigManager:
@@ -27,11 +25,14 @@ class ConfigManager:
 
     def setup_seed(self, seed) -> None:
         """
-        Update random seed.
+        Update random seed. The numpy RNG is only seeded if numpy has already been imported, since the converter itself does
+        not draw numpy random numbers.
         :param seed: New seed.
         """
         self.seed = seed
-        np.random.seed(seed)
+        np = sys.modules.get("numpy")
+        if np is not None:
+            np.random.seed(seed)
         random.seed(seed)
         logging.info("Using seed: %d" % seed)
 
@@ -68,10 +69,13 @@ class ConfigManager:
             logging.basicConfig(level=logging.getLevelName(args.log_level))
 
         self.setup_seed(int(args.seed))
-        self.data_paths = parse_config(args.data_paths)
-        self.parser_config = parse_config(args.parser_config)
-        self.arch_defaults = parse_config(args.arch_defaults)
-        self.room_types = parse_config(osp.join(args.labels_path, "room_types.json"))
+
+        from config_parser import parse_config_cached
+
+        self.data_paths = parse_config_cached(args.data_paths)
+        self.parser_config = parse_config_cached(args.parser_config)
+        self.arch_defaults = parse_config_cached(args.arch_defaults)
+        self.room_types = parse_config_cached(osp.join(args.labels_path, "room_types.json"))
         logging.info("Args: %s" % str(self.args))
 
     def add_args(self, parser: argparse.ArgumentParser) -> None:
@@ -18,4 +18,7 @@ WALL_LINKAGE_SKETCH_HOLE_HIGHLIGHT_WIDTH = 20
 WALL_LINKAGE_SKETCH_THICK_HOLE_WIDTH = 10
 WALL_LINKAGE_SKETCH_HOLE_WIDTH = 5
 WALL_LINKAGE_SKETCH_WALL_WIDTH = 1
-RAND_MAX = 100000
\ No newline at end of file
+RAND_MAX = 100000
+
+TSV_READ_BUFFER_SIZE = 1 << 20  # Read buffer size used for raster-to-vector files
+JSON_WRITE_BUFFER_SIZE = 1 << 20  # Write buffer size used when streaming json files
@@ -1,12 +1,10 @@
 import logging
-
-import numpy as np
+import math
 
 from r2vstk.constants import WALL_LINKAGE_SKETCH_HOLE_HIGHLIGHT_WIDTH, WALL_LINKAGE_SKETCH_THICK_HOLE_WIDTH, WALL_LINKAGE_SKETCH_HOLE_WIDTH, \
     WALL_LINKAGE_SKETCH_WALL_WIDTH
-from r2vstk.util import manhattan_distance_between, find_closest
+from r2vstk.util import manhattan_distance_between, find_closest_grid
 from r2vstk.id_gen import generate_hole_id
-import numbers
 
 
 class Corner:
@@ -14,13 +12,16 @@ class Corner:
     A corner of a line segment
     """
 
+    __slots__ = ('_pos', '_adj', '_index')
+
     def __init__(self, pos):
         assert isinstance(pos, tuple)
         self._pos = pos
         self._adj = []
+        self._index = None  # Index of the corner in the WallLinkageGraph that owns it
 
-    def __hash__(self):
-        return hash(str(self))
+    # Corners are compared by identity and can be moved, so hash them by identity rather than position.
+    __hash__ = object.__hash__
 
     def __str__(self):
         return self.__repr__()
@@ -32,6 +33,10 @@ class Corner:
     def adj(self):
         return self._adj
 
+    @property
+    def index(self) -> int:
+        return self._index
+
     @property
     def pos(self):
         return self._pos
@@ -47,17 +52,21 @@ class Hole:
     A hole line segment indicated on the floorplan
     """
 
+    __slots__ = ('_min_x', '_max_x', '_type', '_id')
+
     def __init__(self, min_x, max_x):
-        assert isinstance(min_x, numbers.Number)
-        assert isinstance(max_x, numbers.Number)
+        assert isinstance(min_x, (int, float))
+        assert isinstance(max_x, (int, float))
 
         self._min_x = min_x
         self._max_x = max_x
         self._type = None
-        self._id = generate_hole_id()
+        self._id = None  # Allocated on first access
 
     @property
     def id(self) -> str:
+        if self._id is None:
+            self._id = generate_hole_id()
         return self._id
 
     @property
@@ -66,7 +75,7 @@ class Hole:
 
     @type.setter
     def type(self, value: str):
-        isinstance(value, str)
+        assert isinstance(value, str)
         self._type = value
 
     @property
@@ -87,8 +96,8 @@ class Hole:
         assert isinstance(value, float)
         self._max_x = value
 
-    def __hash__(self):
-        return hash(str(self))
+    # Holes are compared by identity and their id is allocated lazily, so hash them by identity.
+    __hash__ = object.__hash__
 
     def __str__(self):
         return self.__repr__()
@@ -102,6 +111,8 @@ class LineSegment:
     A line segment
     """
 
+    __slots__ = ('_p1', '_p2')
+
     def __init__(self, p1: Corner, p2: Corner):
         assert isinstance(p1, Corner)
         assert isinstance(p2, Corner)
@@ -127,7 +138,7 @@ class LineSegment:
         self._p2 = value
 
     def __hash__(self):
-        return hash(str(self))
+        return hash((id(self._p1), id(self._p2)))
 
     def __str__(self):
         return self.__repr__()
@@ -141,12 +152,31 @@ class Wall(LineSegment):
     Wall line segment indicated in the floorplan
     """
 
+    __slots__ = ('holes', 'left_room_type', 'right_room_type', '_id', '_unit')
+
+    # Walls are compared by identity, so hash them by identity too.
+    __hash__ = object.__hash__
+
     def __init__(self, p1: Corner, p2: Corner, left_room_type=None, right_room_type=None):
         super().__init__(p1, p2)
         self.holes = []
         self.left_room_type = left_room_type
         self.right_room_type = right_room_type
         self._id = None
+        self._unit = None  # Cached (p1 pos, p2 pos, unit direction) of the wall
+
+    @property
+    def unit(self) -> tuple:
+        """
+        Unit direction vector from p1 to p2. Recomputed only when a corner has moved since the last call.
+        """
+        p1 = self._p1.pos
+        p2 = self._p2.pos
+        if self._unit is None or self._unit[0] is not p1 or self._unit[1] is not p2:
+            dx, dy = p2[0] - p1[0], p2[1] - p1[1]
+            inv_length = 1.0 / math.hypot(dx, dy)
+            self._unit = (p1, p2, (dx * inv_length, dy * inv_length))
+        return self._unit[2]
 
     @property
     def id(self) -> str:
@@ -163,6 +193,8 @@ class AABBAnnotation:
     Object AABB indicated in the floorplan
     """
 
+    __slots__ = ('_type', '_p1', '_p2')
+
     def __init__(self, type=None):
         self._type = type
         self._p1 = None
@@ -191,7 +223,7 @@ class AABBAnnotation:
         return self._type
 
     def __hash__(self):
-        return hash(str(self))
+        return hash((self._type, self._p1, self._p2))
 
     def __repr__(self):
         return self.type + " <(" + str(self.p1[0]) + ", " + str(self.p1[1]) + ") : (" + str(self.p2[0]) + ", " + str(
@@ -211,6 +243,10 @@ class WallLinkageGraph:
         self._wall_corners = {}
         self._tolerance_distance = tolerance_distance
         self._walls = []
+        self._grid = {}  # Mapping from grid cell -> list of (insertion order, corner). Cell size is the tolerance distance.
+        self._corner_count = 0
+        self._corners = []  # All corners of the graph. A corner's index points into this list.
+        self._positions = None  # Cached (N, 2) array of corner positions
 
     @property
     def tolerance_distance(self) -> float:
@@ -224,22 +260,77 @@ class WallLinkageGraph:
     def walls(self) -> list:
         return self._walls
 
+    @property
+    def corners(self) -> list:
+        return self._corners
+
+    @property
+    def positions(self):
+        """
+        Positions of all corners as a (N, 2) float array, row i holding the position of the corner with index i.
+        Built on first access after the corners change. Useful for bulk geometry routines.
+        """
+        if self._positions is None:
+            import numpy as np
+            self._positions = np.array([c.pos for c in self._corners], dtype=np.float64).reshape(-1, 2)
+        return self._positions
+
+    def _grid_cell(self, pos) -> tuple:
+        return int(pos[0] // self._tolerance_distance), int(pos[1] // self._tolerance_distance)
+
+    def _index_corner(self, corner: Corner) -> None:
+        """
+        Register a corner in wall_corners and in the grid used to find nearby corners.
+        """
+        replaced = self._wall_corners.get(corner.pos)
+        if replaced is not None:
+            self._unindex_corner(replaced)
+        self._wall_corners[corner.pos] = corner
+        self._grid.setdefault(self._grid_cell(corner.pos), []).append((self._corner_count, corner))
+        self._corner_count += 1
+        self._positions = None
+
+    def _unindex_corner(self, corner: Corner) -> None:
+        """
+        Remove a corner from wall_corners and the grid.
+        """
+        del self._wall_corners[corner.pos]
+        cell = self._grid[self._grid_cell(corner.pos)]
+        cell[:] = [a for a in cell if a[1] is not corner]
+
+    def _add_corner(self, pos) -> Corner:
+        corner = Corner(pos)
+        corner._index = len(self._corners)
+        self._corners.append(corner)
+        self._index_corner(corner)
+        return corner
+
+    def move_corner(self, corner: Corner, pos: tuple) -> None:
+        """
+        Move a corner to a new position, keeping the corner index up to date.
+        :param corner: Moved corner.
+        :param pos: New position.
+        """
+        self._unindex_corner(corner)
+        corner.pos = pos
+        self._index_corner(corner)
+
     def add_wall(self, p1, p2, left_room_type=None, right_room_type=None):
-        #         if str(p1[0]) + "_" + str(p1[1]) in self.nodes:
+        # Positions double as wall_corners keys, so make sure they are hashable tuples.
+        p1 = (p1[0], p1[1])
+        p2 = (p2[0], p2[1])
 
         if p1[0] == p2[0] and p1[1] == p2[1]:
             logging.info("Not adding wall (%d, %d) : (%d, %d)" % (p1[0], p1[1], p2[0], p2[1]))
             return
 
-        n1, n1_backup = find_closest(p1, self.wall_corners, self.tolerance_distance, [])
+        n1, n1_backup = find_closest_grid(p1, self._grid, self.tolerance_distance, [])
         if n1 is None:
-            n1 = Corner(p1)
-            self.wall_corners[str(p1[0]) + "_" + str(p1[1])] = n1
+            n1 = self._add_corner(p1)
 
-        n2, n2_backup = find_closest(p2, self.wall_corners, self.tolerance_distance, [])
+        n2, n2_backup = find_closest_grid(p2, self._grid, self.tolerance_distance, [])
         if n2 is None:
-            n2 = Corner(p2)
-            self.wall_corners[str(p2[0]) + "_" + str(p2[1])] = n2
+            n2 = self._add_corner(p2)
 
         if n1 == n2:
             # We have a rare scenario where both p1 and p2 are closest to the same node.
@@ -251,12 +342,10 @@ class WallLinkageGraph:
 
         # In case a second closest does not exist
         if n1 is None:
-            n1 = Corner(p1)
-            self.wall_corners[str(p1[0]) + "_" + str(p1[1])] = n1
+            n1 = self._add_corner(p1)
 
         if n2 is None:
-            n2 = Corner(p2)
-            self.wall_corners[str(p2[0]) + "_" + str(p2[1])] = n2
+            n2 = self._add_corner(p2)
 
         assert not (n1.pos[0] == n2.pos[0] and n1.pos[1] == n2.pos[1])
 
@@ -269,9 +358,6 @@ class WallLinkageGraph:
         """
         Sketch wall linkage graph.
         """
-        offset_x = offset[0]
-        offset_y = offset[1]
-
         highlights = []
         if selection is not None:
             if isinstance(selection, Corner):
@@ -281,47 +367,40 @@ class WallLinkageGraph:
                     if isinstance(sel, Wall):
                         highlights.append(sel)
                     elif isinstance(sel, Corner):
-                        highlights.extend(selection.adj)
+                        highlights.extend(sel.adj)
+        highlight_set = frozenset(highlights)
 
+        hole_colors = {"door": door_color, "window": window_color}
         for wall in self.walls:
-            if wall in highlights:
-                draw.line((offset_x + wall.p1.pos[0], offset_y + wall.p1.pos[1], offset_x + wall.p2.pos[0], offset_y + wall.p2.pos[1]), fill=selection_fill,
-                          width=WALL_LINKAGE_SKETCH_WALL_WIDTH)
-
-                wall_start_point = np.array(wall.p1.pos)
-                wall_direction = np.array(wall.p2.pos) - np.array(wall.p1.pos)
-                wall_direction = wall_direction / np.linalg.norm(wall_direction)
-                for hole in wall.holes:
-                    hole_start_point = wall_start_point + wall_direction * hole.min_x
-                    hole_end_point = wall_start_point + wall_direction * hole.max_x
-                    draw.line((offset_x + np.asscalar(hole_start_point[0]), offset_y + np.asscalar(hole_start_point[1]),
-                               offset_x + np.asscalar(hole_end_point[0]), offset_y + np.asscalar(hole_end_point[1])), fill=selection_fill,
-                              width=WALL_LINKAGE_SKETCH_HOLE_HIGHLIGHT_WIDTH)
-                    h_color = hole_color
-                    if hole.type == "door":
-                        h_color = door_color
-                    elif hole.type == "window":
-                        h_color = window_color
-                    draw.line((offset_x + np.asscalar(hole_start_point[0]), offset_y + np.asscalar(hole_start_point[1]),
-                               offset_x + np.asscalar(hole_end_point[0]), offset_y + np.asscalar(hole_end_point[1])), fill=h_color,
-                              width=WALL_LINKAGE_SKETCH_THICK_HOLE_WIDTH)
-
+            if wall in highlight_set:
+                self._sketch_wall(draw, wall, selection_fill, hole_color, hole_colors, WALL_LINKAGE_SKETCH_THICK_HOLE_WIDTH, offset,
+                                  highlight_fill=selection_fill)
             else:
-                draw.line((offset_x + wall.p1.pos[0], offset_y + wall.p1.pos[1], offset_x + wall.p2.pos[0], offset_y + wall.p2.pos[1]), fill=fill,
-                          width=WALL_LINKAGE_SKETCH_WALL_WIDTH)
-
-                wall_start_point = np.array(wall.p1.pos)
-                wall_direction = np.array(wall.p2.pos) - np.array(wall.p1.pos)
-                wall_direction = wall_direction / np.linalg.norm(wall_direction)
-                for hole in wall.holes:
-                    hole_start_point = wall_start_point + wall_direction * hole.min_x
-                    hole_end_point = wall_start_point + wall_direction * hole.max_x
-                    h_color = hole_color
-                    if hole.type == "door":
-                        h_color = door_color
-                    elif hole.type == "window":
-                        h_color = window_color
-
-                    draw.line((offset_x + np.asscalar(hole_start_point[0]), offset_y + np.asscalar(hole_start_point[1]),
-                               offset_x + np.asscalar(hole_end_point[0]), offset_y + np.asscalar(hole_end_point[1])), fill=h_color,
-                              width=WALL_LINKAGE_SKETCH_HOLE_WIDTH)
+                self._sketch_wall(draw, wall, fill, hole_color, hole_colors, WALL_LINKAGE_SKETCH_HOLE_WIDTH, offset)
+
+    def _sketch_wall(self, draw, wall, fill, hole_color, hole_colors: dict, hole_width: int, offset, highlight_fill=None):
+        """
+        Sketch a wall along with its holes.
+        :param hole_color: Color of holes that are neither doors nor windows.
+        :param hole_colors: Mapping from hole type to color.
+        :param hole_width: Line width used for holes.
+        :param highlight_fill: If specified, holes are drawn over a wider band of this color.
+        """
+        line = draw.line
+        hole_color_of = hole_colors.get
+        highlight_width = WALL_LINKAGE_SKETCH_HOLE_HIGHLIGHT_WIDTH
+
+        p1 = wall.p1.pos
+        p2 = wall.p2.pos
+        start_x = offset[0] + p1[0]
+        start_y = offset[1] + p1[1]
+        line((start_x, start_y, offset[0] + p2[0], offset[1] + p2[1]), fill=fill, width=WALL_LINKAGE_SKETCH_WALL_WIDTH)
+
+        ux, uy = wall.unit
+        for hole in wall.holes:
+            min_x = hole.min_x
+            max_x = hole.max_x
+            hole_line = (start_x + ux * min_x, start_y + uy * min_x, start_x + ux * max_x, start_y + uy * max_x)
+            if highlight_fill is not None:
+                line(hole_line, fill=highlight_fill, width=highlight_width)
+            line(hole_line, fill=hole_color_of(hole.type, hole_color), width=hole_width)
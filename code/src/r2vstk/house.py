@@ -1,24 +1,37 @@
 from r2vstk.config_manager import ConfigManager
 from r2vstk.constants import RAW_SKETCH_MARGIN, RAW_WALL_COLOR, RAW_ENTRANCE_COLOR, RAW_LABEL_COLOR, RAW_STAIR_COLOR, RAW_OBJECT_COLOR, RAW_DOOR_COLOR, \
     ROOM_SKETCH_MARGIN, ROOM_SKETCH_WALL_COLOR, ROOM_SKETCH_HOLE_COLOR, ROOM_SKETCH_WINDOW_COLOR, ROOM_SKETCH_DOOR_COLOR, ROOM_SKETCH_ROOM_ANNOTATION_COLOR, \
-    ROOM_SKETCH_ROOM_ANNOTATION_LABEL_COLOR, ROOM_SKETCH_SELECTED_ROOM_COLOR, ROOM_SKETCH_DOOR_CONNECTED_ADJACENT_ROOM_COLOR
+    ROOM_SKETCH_ROOM_ANNOTATION_LABEL_COLOR, ROOM_SKETCH_SELECTED_ROOM_COLOR, ROOM_SKETCH_DOOR_CONNECTED_ADJACENT_ROOM_COLOR, \
+    TSV_READ_BUFFER_SIZE
 
-from r2vstk.id_gen import generate_room_id
+from r2vstk.id_gen import generate_room_id, generate_wall_id
 from r2vstk.json_util import generate_ceiling_json, generate_floor_json, generate_wall_json
 from r2vstk.room_description import RoomDescription
 from r2vstk.util import find_room, line_contains_check, get_closest_and_furthest, manhattan_distance_between, \
-    get_polyline, sq_distance, convert_int, rect_line_distance, hole_to_line
+    convert_int, rect_line_distance, hole_to_line
 import math
 import csv
 from r2vstk.exceptions import StraightenWallsFailed
 
 from PIL import Image, ImageDraw
 from PIL import ImageFont
-from shapely.geometry import Polygon, LineString
+import numpy as np
+import shapely
+from shapely import GeometryType, STRtree
 from r2vstk.floorplan import WallLinkageGraph, Corner, Hole, AABBAnnotation, LineSegment
 import logging
 import os.path as osp
-from r2vstk.wall_split_utils import find_connections
+from bisect import bisect_left
+from functools import lru_cache
+from r2vstk.wall_split_utils import find_connections, may_connect
+
+
+@lru_cache(maxsize=8)
+def _load_font(path: str, size: int):
+    """
+    Load a truetype font. Cached since sketches are drawn for every room.
+    """
+    return ImageFont.truetype(path, size)
 
 
 class House:
@@ -29,6 +42,7 @@ class House:
     def __init__(self):
         # Configuration
         self.file_name = None
+        self.scene_id = None  # Scene ID derived from file_name
         self.multiplication_factor = 1  # Scale factor to real world
 
         # Parsed raw data
@@ -40,6 +54,8 @@ class House:
         self.stairs = []
 
         self.wall_graph = None  # Wall-corner-wall linkage graph. This is used to identify rooms as polygons.
+        self._wall_graph_fresh = False  # Whether wall_graph is generated from the current walls and openings
+        self._scaled_positions = None  # Cached (wall_graph.positions, multiplication_factor, scaled positions)
 
         # Bounds
         self.x_min = None
@@ -49,7 +65,9 @@ class House:
 
         # High level annotations
         self.ordered_rooms = None  # Room keys in a fixed order used for indexing
+        self._room_indices = {}  # Mapping from room_key -> index in ordered_rooms
         self.room_description_map = {}  # Mapping from room_key -> RoomDescription
+        self._wall_to_rooms = None  # Cached mapping from wall -> keys of adjacent rooms. Reset when room_description_map changes.
         self.object_annotations = []  # AABBs of objects
 
         self.rdr = []  # Room door room edges
@@ -59,19 +77,49 @@ class House:
         Load a parsed r2v file.
         :param data: Parsed R2V tsv file.
         """
-        self.walls = [x for x in data if x["category"] == "wall"]
-        self.raw_objects = [r for r in data if r["category"] not in ["wall", "door", "entrance"]]
-        self.openings = [x for x in data if x["category"] == "door"]
-
-        self.entrances = [x for x in data if x["category"] == "entrance"]
-        self.stairs = [x for x in data if x["category"] == "stairs"]
-
-        self.raw_room_annotations = [a for a in data if a["category"] not in ["wall", "door"]]
-
-        self.x_min = min([x["x_min"] for x in data] + [x["x_max"] for x in data])
-        self.y_min = min([x["y_min"] for x in data] + [x["y_max"] for x in data])
-        self.x_max = max([x["x_min"] for x in data] + [x["x_max"] for x in data])
-        self.y_max = max([x["y_min"] for x in data] + [x["y_max"] for x in data])
+        self.walls = []
+        self.raw_objects = []
+        self.openings = []
+        self.entrances = []
+        self.stairs = []
+        self.raw_room_annotations = []
+        self._wall_graph_fresh = False
+        if self.file_name is not None:
+            self.scene_id = osp.splitext(osp.dirname(self.file_name))[0]
+
+        for datum in data:
+            category = datum["category"]
+            if category == "wall":
+                self.walls.append(datum)
+            elif category == "door":
+                self.openings.append(datum)
+            else:
+                self.raw_room_annotations.append(datum)
+                if category == "entrance":
+                    self.entrances.append(datum)
+                else:
+                    self.raw_objects.append(datum)
+                    if category == "stairs":
+                        self.stairs.append(datum)
+
+        if len(data) == 0:
+            self.x_min = self.y_min = math.inf
+            self.x_max = self.y_max = -math.inf
+            return
+        coords = self._coords_of(data)
+        self.x_min = coords[:, 0::2].min().item()
+        self.y_min = coords[:, 1::2].min().item()
+        self.x_max = coords[:, 0::2].max().item()
+        self.y_max = coords[:, 1::2].max().item()
+
+    @staticmethod
+    def _coords_of(data: list) -> np.ndarray:
+        """
+        Pack the coordinates of parsed r2v items into an array.
+        :param data: List of parsed r2v items.
+        :return: (N, 4) array with columns x_min, y_min, x_max, y_max.
+        """
+        return np.array([(d["x_min"], d["y_min"], d["x_max"], d["y_max"]) for d in data]).reshape(-1, 4)
 
     def load_r2v_output_file(self, conf: ConfigManager, source_path: str) -> None:
         """
@@ -80,40 +128,30 @@ class House:
         :param source_path: Path to r2v file.
         """
         category_list = conf.room_types
-        data = []
         self.file_name = source_path
-        wall_count = -1
-        with open(source_path) as tsvfile:
-            tsvreader = csv.reader(tsvfile, delimiter="\t")
-            for i, line in enumerate(tsvreader):
-                if i == 0:
-                    continue  # We dont need width and height
-                if i == 1:
-                    wall_count = convert_int(line[0])
-                    continue
-                if i < wall_count + 2:
-                    assert len(line) == 6
-                    datum = {
-                        "x_min": convert_int(line[0]),
-                        "y_min": convert_int(line[1]),
-                        "x_max": convert_int(line[2]),
-                        "y_max": convert_int(line[3]),
-                        "category": "wall",
-                        "left_room_type": category_list[convert_int(line[4])],
-                        "right_room_type": category_list[convert_int(line[5])]
-                    }
-                else:
-                    assert len(line) == 7
-                    datum = {
-                        "x_min": convert_int(line[0]),
-                        "y_min": convert_int(line[1]),
-                        "x_max": convert_int(line[2]),
-                        "y_max": convert_int(line[3]),
-                        "category": line[4],
-                        "dump_1": line[5],
-                        "dump_2": line[6]
-                    }
-                data.append(datum)
+        with open(source_path, newline="", buffering=TSV_READ_BUFFER_SIZE) as tsvfile:
+            rows = list(csv.reader(tsvfile, delimiter="\t"))
+
+        # First line holds width and height, which we dont need. Second line holds the wall count.
+        if len(rows) < 2:
+            self._load_data([])
+            return
+        wall_count = convert_int(rows[1][0])
+        wall_rows = rows[2:max(wall_count + 2, 2)]
+        other_rows = rows[max(wall_count + 2, 2):]
+        assert all(len(line) == 6 for line in wall_rows)
+        assert all(len(line) == 7 for line in other_rows)
+
+        data = [{
+            "x_min": convert_int(line[0]),
+            "y_min": convert_int(line[1]),
+            "x_max": convert_int(line[2]),
+            "y_max": convert_int(line[3]),
+            "category": "wall",
+            "left_room_type": category_list[convert_int(line[4])],
+            "right_room_type": category_list[convert_int(line[5])]
+        } for line in wall_rows]
+        data.extend(self._parse_object_rows(other_rows))
         self._load_data(data)
 
     def load_r2v_annot_file(self, source_path: str):
@@ -121,23 +159,27 @@ class House:
         Load a raster-to-vector annotation file.
         :param source_path: Path to raster-to-vector annotation file.
         """
-        data = []
         self.file_name = source_path
+        with open(source_path, newline="", buffering=TSV_READ_BUFFER_SIZE) as tsvfile:
+            rows = list(csv.reader(tsvfile, delimiter="\t"))
+        self._load_data(self._parse_object_rows(rows))
 
-        with open(source_path) as tsvfile:
-            tsvreader = csv.reader(tsvfile, delimiter="\t")
-            for line in tsvreader:
-                datum = {
-                    "x_min": convert_int(line[0]),
-                    "y_min": convert_int(line[1]),
-                    "x_max": convert_int(line[2]),
-                    "y_max": convert_int(line[3]),
-                    "category": line[4],
-                    "dump_1": line[5],
-                    "dump_2": line[6]
-                }
-                data.append(datum)
-        self._load_data(data)
+    @staticmethod
+    def _parse_object_rows(rows: list) -> list:
+        """
+        Parse rows of the form (x_min, y_min, x_max, y_max, category, dump_1, dump_2).
+        :param rows: Rows read from a raster-to-vector file.
+        :return: List of data dicts.
+        """
+        return [{
+            "x_min": convert_int(line[0]),
+            "y_min": convert_int(line[1]),
+            "x_max": convert_int(line[2]),
+            "y_max": convert_int(line[3]),
+            "category": line[4],
+            "dump_1": line[5],
+            "dump_2": line[6]
+        } for line in rows]
 
     def split_source_walls(self, conf: ConfigManager) -> None:
         """
@@ -145,100 +187,121 @@ class House:
         :param conf: ConfigManager
         """
         # Method adapted from raster-to-vector project.
-        start_over = False
-        changed = True
-        left_iterations = conf.parser_config.split_walls.max_iter
-        while changed and left_iterations > 0:
-            left_iterations -= 1
-            changed = False
-            for i1, wall1 in enumerate(self.walls):
-                if start_over:
-                    start_over = False
-                    break
+        # Each round splits the first (wall1, wall2) pair in list order that needs splitting, and then starts over. Pairs found not to
+        # need a split are not tested again, so a round only tests the pairs that are still pending.
+        # Walls are numbered in the order they are added. A split deletes a wall and appends its two segments, so self.walls stays sorted by
+        # number, and the walls not yet tested against a wall1 are always those numbered from some start onwards.
+        max_iter = conf.parser_config.split_walls.max_iter
+        wall_numbers = list(range(len(self.walls)))  # Number of each wall in self.walls
+        next_number = len(self.walls)
+        pending = {}  # Number of wall1 -> number of the first wall not yet tested against wall1. Holds an entry for every manhattan wall.
+        coords = self._coords_of(self.walls)
+        is_manhattan = (coords[:, 0] == coords[:, 2]) | (coords[:, 1] == coords[:, 3])
+        for number, manhattan in zip(wall_numbers, is_manhattan.tolist()):
+            if manhattan:
+                pending[number] = 0
+
+        split_count = 0
+        while split_count < max_iter:
+            split = self._find_wall_split(wall_numbers, pending, conf)
+            if split is None:
+                break
+            i, p = split
+            to_break = self.walls[i]
+            logging.info("Break " + str(to_break))
+            seg1, seg2 = self._split_wall(to_break, p)
+
+            pending.pop(wall_numbers[i], None)
+            del self.walls[i]
+            del wall_numbers[i]
+            for seg in (seg1, seg2):
+                self.walls.append(seg)
+                wall_numbers.append(next_number)
+                if self._is_manhattan_wall(seg):
+                    pending[next_number] = 0
+                next_number += 1
+            self._wall_graph_fresh = False
+            split_count += 1
+        else:
+            logging.warning("Split walls iterations truncated: " + str(self.file_name))
 
-                # Only apply for manhattan walls
-                if wall1["x_min"] == wall1["x_max"] or wall1["y_min"] == wall1["y_max"]:
-                    pass
-                else:
-                    continue
+    @staticmethod
+    def _is_manhattan_wall(wall) -> bool:
+        return wall["x_min"] == wall["x_max"] or wall["y_min"] == wall["y_max"]
 
-                for i2, wall2 in enumerate(self.walls):
-                    # Only apply for manhattan walls
-                    if wall2["x_min"] == wall2["x_max"] or wall2["y_min"] == wall2["y_max"]:
-                        pass
-                    else:
-                        continue
-
-                    if wall1 == wall2:
-                        continue
-                    t, p = find_connections(((wall1["x_min"], wall1["y_min"]), (wall1["x_max"], wall1["y_max"])),
-                                            ((wall2["x_min"], wall2["y_min"]), (wall2["x_max"], wall2["y_max"])),
-                                            conf.parser_config.wall_join_margin)
-
-                    to_break = None
-                    other = None
-                    to_break_i = None
-                    if t[0] == 2:
-                        to_break = wall1
-                        to_break_i = i1
-                        other = wall2
-                        logging.info("Break " + str(wall1))
-                    elif t[1] == 2:
-                        to_break = wall2
-                        to_break_i = i2
-                        other = wall1
-                        logging.info("Break " + str(wall2))
-
-                    if to_break is not None:
-                        seg1 = {
-                            "x_min": to_break["x_min"],
-                            "y_min": to_break["y_min"],
-                            "x_max": p[0],
-                            "y_max": p[1],
-                            "category": "wall"
-                        }
-                        seg2 = {
-                            "x_min": p[0],
-                            "y_min": p[1],
-                            "x_max": to_break["x_max"],
-                            "y_max": to_break["y_max"],
-                            "category": "wall"
-                        }
-                        if "left_room_type" in to_break:
-                            seg1["left_room_type"] = to_break["left_room_type"]
-                            seg2["left_room_type"] = to_break["left_room_type"]
-
-                        if "right_room_type" in to_break:
-                            seg1["right_room_type"] = to_break["right_room_type"]
-                            seg2["right_room_type"] = to_break["right_room_type"]
-
-                        if "dump1" in to_break:
-                            seg1["dump1"] = to_break["dump1"]
-                            seg2["dump1"] = to_break["dump1"]
-
-                        if "dump2" in to_break:
-                            seg1["dump2"] = to_break["dump2"]
-                            seg2["dump2"] = to_break["dump2"]
-
-                        del self.walls[to_break_i]
-                        self.walls.append(seg1)
-                        self.walls.append(seg2)
-                        start_over = True
-                        changed = True
-                        break
-        if left_iterations == 0:
-            logging.warning("Split walls iterations truncated: " + str(self.file_name))
+    def _find_wall_split(self, wall_numbers: list, pending: dict, conf: ConfigManager):
+        """
+        Find the first pair of walls, in list order, where a wall needs to be split at its junction with the other wall.
+        Tested pairs that do not need a split are marked as tested in pending.
+        :param wall_numbers: Number of each wall in self.walls, in increasing order.
+        :param pending: Mapping from number of wall1 -> number of the first wall not yet tested against wall1, for each manhattan wall1.
+        :param conf: ConfigManager
+        :return: Tuple (index of the wall to split in self.walls, split point) or None.
+        """
+        walls = self.walls
+        for i1, (wall1, number1) in enumerate(zip(walls, wall_numbers)):
+            start = pending.get(number1)
+            if start is None:
+                continue  # Only apply for manhattan walls
+            line1 = ((wall1["x_min"], wall1["y_min"]), (wall1["x_max"], wall1["y_max"]))
+            for i2 in range(bisect_left(wall_numbers, start), len(walls)):
+                number2 = wall_numbers[i2]
+                wall2 = walls[i2]
+                if number2 not in pending or wall1 == wall2:
+                    continue
+                line2 = ((wall2["x_min"], wall2["y_min"]), (wall2["x_max"], wall2["y_max"]))
+                if not may_connect(line1, line2):
+                    continue
+                t, p = find_connections(line1, line2, conf.parser_config.wall_join_margin)
+                if t[0] == 2 or t[1] == 2:
+                    pending[number1] = number2 + 1
+                    return (i1 if t[0] == 2 else i2), p
+            pending[number1] = wall_numbers[-1] + 1
+        return None
+
+    def _split_wall(self, to_break: dict, p: tuple) -> tuple:
+        """
+        Split a wall into two segments at point p.
+        :return: Tuple of the two segments.
+        """
+        seg1 = {
+            "x_min": to_break["x_min"],
+            "y_min": to_break["y_min"],
+            "x_max": p[0],
+            "y_max": p[1],
+            "category": "wall"
+        }
+        seg2 = {
+            "x_min": p[0],
+            "y_min": p[1],
+            "x_max": to_break["x_max"],
+            "y_max": to_break["y_max"],
+            "category": "wall"
+        }
+        for key in ["left_room_type", "right_room_type", "dump1", "dump2"]:
+            if key in to_break:
+                seg1[key] = to_break[key]
+                seg2[key] = to_break[key]
+        return seg1, seg2
 
     def _find_adjacent_rooms(self, wall):
         """
         Find adjacent rooms of to a wall.
         :return: List of adjacent rooms
         """
-        adjacent_rooms = []
+        if self._wall_to_rooms is None:
+            self._build_wall_to_rooms()
+        return self._wall_to_rooms.get(wall, [])
+
+    def _build_wall_to_rooms(self) -> None:
+        """
+        Map each wall to the keys of rooms it bounds, in room_description_map order.
+        """
+        wall_to_rooms = {}
         for room_key in self.room_description_map:
-            if wall in room_key:
-                adjacent_rooms.append(room_key)
-        return adjacent_rooms
+            for wall in room_key:
+                wall_to_rooms.setdefault(wall, []).append(room_key)
+        self._wall_to_rooms = wall_to_rooms
 
     def compute_rdr(self) -> None:
         """
@@ -265,10 +328,7 @@ class House:
         for wall in self.wall_graph.walls:
             # Check whether wall is internal
             wall_internal = False
-            adjacent_rooms_keys = []
-            for room_key in self.room_description_map:
-                if wall in list(room_key):
-                    adjacent_rooms_keys.append(room_key)
+            adjacent_rooms_keys = self._find_adjacent_rooms(wall)
             assert len(adjacent_rooms_keys) <= 2
             if len(adjacent_rooms_keys) == 2:
                 wall_internal = True
@@ -312,50 +372,44 @@ class House:
 
         straighten_walls_cutoff_gradient = conf.parser_config.straighten_walls.cutoff_gradient
         max_iter_count = conf.parser_config.straighten_walls.max_iter
+        cutoff_gradient_sq = straighten_walls_cutoff_gradient ** 2
         iter_count = 0
         while iter_count < max_iter_count:
             try:
                 found_wall = None
+                x_correction = False  # Whether found_wall is inclined from the y axis (its x coordinates differ slightly)
                 for wall in self.wall_graph.walls:
-                    if 0 < abs(wall.p1.pos[0] - wall.p2.pos[0]) / sq_distance(wall.p1.pos, wall.p2.pos) < straighten_walls_cutoff_gradient:
+                    # Compare squared quantities to avoid a sqrt and a division per wall.
+                    p1 = wall.p1.pos
+                    p2 = wall.p2.pos
+                    dx = p1[0] - p2[0]
+                    dy = p1[1] - p2[1]
+                    max_sq_offset = cutoff_gradient_sq * (dx * dx + dy * dy)
+                    if 0 < dx * dx < max_sq_offset:
                         found_wall = wall
-                        logging.info("Inclined Wall " + str(wall) + " : " + str(abs(wall.p1.pos[0] - wall.p2.pos[0]) / sq_distance(wall.p1.pos, wall.p2.pos)))
+                        x_correction = True
+                        logging.info("Inclined Wall " + str(wall) + " : " + str(abs(dx) / math.hypot(dx, dy)))
                         break
 
-                    if 0 < abs(wall.p1.pos[1] - wall.p2.pos[1]) / sq_distance(wall.p1.pos, wall.p2.pos) < straighten_walls_cutoff_gradient:
+                    if 0 < dy * dy < max_sq_offset:
                         found_wall = wall
-                        logging.info("Inclined Wall " + str(wall) + " : " + str(abs(wall.p1.pos[1] - wall.p2.pos[1]) / sq_distance(wall.p1.pos, wall.p2.pos)))
+                        logging.info("Inclined Wall " + str(wall) + " : " + str(abs(dy) / math.hypot(dx, dy)))
                         break
                 if found_wall is None:
                     break
                 else:
-                    found_key = str(found_wall)
-                    moved_point_key = None
-                    move_point = None
-                    if 0 < abs(found_wall.p1.pos[0] - found_wall.p2.pos[0]) / sq_distance(found_wall.p1.pos,
-                                                                                          found_wall.p2.pos) < straighten_walls_cutoff_gradient:
+                    if x_correction:
                         # This is a x axis correction. Move the top vertex
                         if found_wall.p1.pos[1] < found_wall.p2.pos[1]:
-                            moved_point_key = str(found_wall.p1)
-                            move_point = found_wall.p1
-                            found_wall.p1.pos = (found_wall.p2.pos[0], found_wall.p1.pos[1])
+                            self.wall_graph.move_corner(found_wall.p1, (found_wall.p2.pos[0], found_wall.p1.pos[1]))
                         else:
-                            moved_point_key = str(found_wall.p2)
-                            move_point = found_wall.p2
-                            found_wall.p2.pos = (found_wall.p1.pos[0], found_wall.p2.pos[1])
+                            self.wall_graph.move_corner(found_wall.p2, (found_wall.p1.pos[0], found_wall.p2.pos[1]))
                     else:
                         # This is a y axis correction. Move the left vertex
                         if found_wall.p1.pos[0] < found_wall.p2.pos[0]:
-                            moved_point_key = str(found_wall.p1)
-                            move_point = found_wall.p1
-                            found_wall.p1.pos = (found_wall.p1.pos[0], found_wall.p2.pos[1])
+                            self.wall_graph.move_corner(found_wall.p1, (found_wall.p1.pos[0], found_wall.p2.pos[1]))
                         else:
-                            moved_point_key = str(found_wall.p2)
-                            move_point = found_wall.p2
-                            found_wall.p2.pos = (found_wall.p2.pos[0], found_wall.p1.pos[1])
-
-                    del self.wall_graph.wall_corners[moved_point_key]
-                    self.wall_graph.wall_corners[str(move_point)] = move_point
+                            self.wall_graph.move_corner(found_wall.p2, (found_wall.p2.pos[0], found_wall.p1.pos[1]))
                 iter_count += 1
             except Exception as e:
                 raise StraightenWallsFailed(house_path=self.file_name, iter_count=iter_count) from e
@@ -368,47 +422,49 @@ class House:
         :param conf: ConfigManager
         """
         eliminate_false_rooms_threshold = conf.parser_config.eliminate_false_rooms.threshold
-        fully_contained_keys = []
-        for parent_candidate_key in self.room_description_map:
-            contained_children = []
-            parent_polyline = get_polyline(self.room_description_map[parent_candidate_key].walls)
-            if len(parent_polyline) < 3:
+
+        # Build each room polygon once.
+        room_keys = []
+        room_polygons = []
+        for room_key, rd in self.room_description_map.items():
+            polyline = rd.polyline
+            if len(polyline) < 3:
                 continue
             try:
-                parent_polygon = Polygon(parent_polyline)
+                room_polygons.append(rd.polygon)
             except:
                 logging.error("exception in processing " + self.file_name, exc_info=1)
                 continue
+            room_keys.append(room_key)
+        room_polygons = np.array(room_polygons, dtype=object)
+        room_areas = shapely.area(room_polygons)
+        tree = STRtree(room_polygons)
 
-            for child_candidate_key in self.room_description_map:
-                if child_candidate_key == parent_candidate_key:
-                    continue
-                child_polyline = get_polyline(self.room_description_map[child_candidate_key].walls)
-                if len(child_polyline) < 3:
-                    continue
-                try:
-                    child_polygon = Polygon(child_polyline)
-                except:
-                    logging.error("exception in processing " + self.file_name, exc_info=1)
-                    continue
+        fully_contained_keys = []
+        for parent_i, parent_candidate_key in enumerate(room_keys):
+            parent_polygon = room_polygons[parent_i]
+            child_is = np.sort(tree.query(parent_polygon, predicate="intersects"))
+            child_is = child_is[child_is != parent_i]
 
-                intersection = parent_polygon.intersection(child_polygon)
-                if isinstance(intersection, Polygon):
-                    if intersection.area > 0:
-                        contained_children.append((child_candidate_key, child_polygon.area, child_polygon))
+            # A child counts when it overlaps the parent in a polygon of non-zero area.
+            intersections = shapely.intersection(parent_polygon, room_polygons[child_is])
+            contained = (shapely.get_type_id(intersections) == GeometryType.POLYGON) & (shapely.area(intersections) > 0)
 
-            total_area = sum([a[1] for a in contained_children])
-            if abs(total_area - parent_polygon.area) < parent_polygon.area * eliminate_false_rooms_threshold:
+            total_area = sum(room_areas[child_is[contained]].tolist())
+            if abs(total_area - room_areas[parent_i]) < room_areas[parent_i] * eliminate_false_rooms_threshold:
                 fully_contained_keys.append(parent_candidate_key)
                 logging.info("Fully contained " + str(parent_candidate_key) + " : " + str(total_area))
         for fck in fully_contained_keys:
             del self.room_description_map[fck]
+        self._wall_to_rooms = None
 
     def generate_wall_graph(self, conf: ConfigManager) -> None:
         """
-        Generate wall-corner-wall linkage graph
+        Generate wall-corner-wall linkage graph. Does nothing if the graph is already generated from the current walls and openings.
         :param conf: Config Manager
         """
+        if self._wall_graph_fresh:
+            return
         self.wall_graph = WallLinkageGraph(conf.parser_config.wall_join_margin)
         for wall in self.walls:
             left_room_type = None
@@ -422,12 +478,16 @@ class House:
 
         # Detect rooms
         self.room_description_map = {}
+        self._wall_to_rooms = None
+        # Each room is traced from each of its walls, so share the turn taken at each (corner, in wall) and the wall angles at each corner.
+        next_wall_cache = {}
+        wall_angle_cache = {}
         for wall in self.wall_graph.walls:
-            r1 = find_room(wall.p1, wall)
+            r1 = find_room(wall.p1, wall, next_wall_cache, wall_angle_cache)
             room_key1 = frozenset(r1)
             self.room_description_map[room_key1] = RoomDescription(room_key1, r1)
 
-            r2 = find_room(wall.p2, wall)
+            r2 = find_room(wall.p2, wall, next_wall_cache, wall_angle_cache)
             room_key2 = frozenset(r2)
             self.room_description_map[room_key2] = RoomDescription(room_key2, r2)
 
@@ -436,20 +496,28 @@ class House:
             self._eliminate_false_rooms(conf)
 
         self.ordered_rooms = list(self.room_description_map.keys())
+        self._room_indices = {room_key: i for i, room_key in enumerate(self.ordered_rooms)}
 
         # Add doors
         w_doors = [LineSegment(Corner((p["x_min"], p["y_min"])), Corner((p["x_max"], p["y_max"]))) for p in self.openings]
 
+        max_door_perpendicular_offset = conf.parser_config.max_door_perpendicular_offset
+        walls = self.wall_graph.walls
+        positions = self.wall_graph.positions
+        wall_p1s = positions[[wall.p1.index for wall in walls]].reshape(-1, 2)
+        wall_p2s = positions[[wall.p2.index for wall in walls]].reshape(-1, 2)
+
         wall_door_pairs = []
         for door in w_doors:
-            for wall in self.wall_graph.walls:
-                line_contains, pd = line_contains_check(wall, door, conf.parser_config.max_door_perpendicular_offset)
+            for wall_i in self._find_walls_near_line(wall_p1s, wall_p2s, door, max_door_perpendicular_offset):
+                wall = walls[wall_i]
+                line_contains, pd = line_contains_check(wall, door, max_door_perpendicular_offset)
                 if line_contains:
                     wall_door_pairs.append((pd, door, wall))
 
         wall_door_pairs = sorted(wall_door_pairs, key=lambda x: x[0])
 
-        added_doors = []
+        added_doors = set()
         for pd, door, wall in wall_door_pairs:
             if door in added_doors:
                 continue
@@ -457,12 +525,40 @@ class House:
             min_point, max_point = get_closest_and_furthest(wall.p1.pos, door.p1.pos, door.p2.pos)
             new_door = Hole(manhattan_distance_between(wall.p1.pos, min_point), manhattan_distance_between(wall.p1.pos, max_point))
             wall.holes.append(new_door)
-            added_doors.append(door)
+            added_doors.add(door)
 
         for door in w_doors:
             if door not in added_doors:
                 logging.warning("Door not added: " + str(door) + " : " + self.file_name)
 
+        self._wall_graph_fresh = True
+
+    @staticmethod
+    def _find_walls_near_line(wall_p1s: np.ndarray, wall_p2s: np.ndarray, line: LineSegment, pd_margin: float) -> list:
+        """
+        Find walls that have both end points of a line within pd_margin of the wall's extended line.
+        This is a necessary condition of line_contains_check, evaluated for all walls at once.
+        :param wall_p1s: (N, 2) array of wall p1 positions.
+        :param wall_p2s: (N, 2) array of wall p2 positions.
+        :param line: Tested line segment.
+        :param pd_margin: Perpendicular distance margin.
+        :return: Indices of candidate walls, in ascending order.
+        """
+        c1 = line.p1.pos
+        c2 = line.p2.pos
+        dx = wall_p2s[:, 0] - wall_p1s[:, 0]
+        dy = wall_p2s[:, 1] - wall_p1s[:, 1]
+        vertical = dx == 0
+        with np.errstate(divide="ignore", invalid="ignore"):
+            grad = dy / dx
+            intercept = wall_p1s[:, 1] - grad * wall_p1s[:, 0]
+            norm = np.sqrt(grad ** 2 + 1)
+            pd1 = np.where(vertical, np.abs(c1[0] - wall_p1s[:, 0]), np.abs(-grad * c1[0] + c1[1] - intercept) / norm)
+            pd2 = np.where(vertical, np.abs(c2[0] - wall_p2s[:, 0]), np.abs(-grad * c2[0] + c2[1] - intercept) / norm)
+        # Allow for rounding differences with the scalar check, which makes the final decision.
+        pd_margin = pd_margin + 1e-6
+        return np.flatnonzero((pd1 <= pd_margin) & (pd2 <= pd_margin)).tolist()
+
     def populate_object_annotations(self, conf: ConfigManager) -> None:
         """
         Populate the list of object annotations
@@ -481,32 +577,38 @@ class House:
         """
         Returns the shapely shape containing walls. The windows and doors are depicted by holes. This mask can be used for 2D ray hit tests.
         """
-        processed_walls = []
-        all_lines = []
+        walls = []
+        processed_walls = set()
         for room_key in self.room_description_map:
-            room_walls = self.room_description_map[room_key].walls
-            for wall in room_walls:
-                if wall in processed_walls:
-                    continue
-
-                wall_length = math.sqrt((wall.p2.pos[0] - wall.p1.pos[0]) ** 2 + (wall.p2.pos[1] - wall.p1.pos[1]) ** 2)
-
-                ls = LineString([(wall.p1.pos[0], wall.p1.pos[1]), (wall.p2.pos[0], wall.p2.pos[1])]).buffer(1)
-
-                for hole in wall.holes:
-                    h_start_x = ((wall.p2.pos[0] - wall.p1.pos[0]) / wall_length * hole.min_x) + wall.p1.pos[0]
-                    h_end_x = ((wall.p2.pos[0] - wall.p1.pos[0]) / wall_length * hole.max_x) + wall.p1.pos[0]
-                    h_start_y = ((wall.p2.pos[1] - wall.p1.pos[1]) / wall_length * hole.min_x) + wall.p1.pos[1]
-                    h_end_y = ((wall.p2.pos[1] - wall.p1.pos[1]) / wall_length * hole.max_x) + wall.p1.pos[1]
-
-                    hs = LineString([(h_start_x, h_start_y), (h_end_x, h_end_y)]).buffer(1)
-                    ls = ls.difference(hs)
+            for wall in self.room_description_map[room_key].walls:
+                if wall not in processed_walls:
+                    processed_walls.add(wall)
+                    walls.append(wall)
+        if len(walls) == 0:
+            return shapely.union_all([])
+
+        wall_coords = np.array([[wall.p1.pos, wall.p2.pos] for wall in walls], dtype=np.float64)
+        hole_coords = []
+        hole_wall_indices = []
+        for wall_i, wall in enumerate(walls):
+            if len(wall.holes) == 0:
+                continue
+            ux, uy = wall.unit
+            for hole in wall.holes:
+                hole_coords.append([(wall.p1.pos[0] + ux * hole.min_x, wall.p1.pos[1] + uy * hole.min_x),
+                                    (wall.p1.pos[0] + ux * hole.max_x, wall.p1.pos[1] + uy * hole.max_x)])
+                hole_wall_indices.append(wall_i)
 
-                all_lines.append(ls)
+        wall_shapes = shapely.buffer(shapely.linestrings(wall_coords), 1, quad_segs=16)
+        if len(hole_coords) > 0:
+            # Cut the holes of each wall out of that wall only.
+            hole_shapes = shapely.buffer(shapely.linestrings(np.array(hole_coords, dtype=np.float64)), 1, quad_segs=16)
+            hole_wall_indices = np.array(hole_wall_indices)
+            walls_with_holes = np.unique(hole_wall_indices)
+            wall_hole_shapes = [shapely.union_all(hole_shapes[hole_wall_indices == wall_i]) for wall_i in walls_with_holes]
+            wall_shapes[walls_with_holes] = shapely.difference(wall_shapes[walls_with_holes], wall_hole_shapes)
 
-        from shapely.ops import cascaded_union
-        u = cascaded_union(all_lines)
-        return u
+        return shapely.union_all(wall_shapes)
 
     def populate_room_annotations(self, conf: ConfigManager) -> None:
         """
@@ -519,19 +621,49 @@ class House:
             obj.p1 = (ro["x_min"], ro["y_min"])
             obj.p2 = (ro["x_max"], ro["y_max"])
             annotations.append(obj)
+        if len(annotations) == 0:
+            return
 
-        for room_key in self.room_description_map:
-            room_poly = Polygon(get_polyline(self.room_description_map[room_key].walls))
-            for annotation in annotations:
-                annotation_polygon = Polygon(
-                    [(annotation.p1[0], annotation.p1[1]), (annotation.p2[0], annotation.p1[1]),
-                     (annotation.p2[0], annotation.p2[1]), (annotation.p1[0], annotation.p2[1])])
-                intersection = room_poly.intersection(annotation_polygon)
-                if isinstance(intersection, Polygon):
-                    if abs(intersection.area - annotation_polygon.area) < annotation_polygon.area * conf.parser_config.room_label_assignment_overlap:
-                        self.room_description_map[room_key].annotations.append(annotation)
+        room_keys = list(self.room_description_map.keys())
+        room_polys = np.array([self.room_description_map[room_key].polygon for room_key in room_keys], dtype=object)
+        annotation_polys = shapely.polygons(np.array(
+            [[(a.p1[0], a.p1[1]), (a.p2[0], a.p1[1]), (a.p2[0], a.p2[1]), (a.p1[0], a.p2[1])] for a in annotations], dtype=np.float64))
+
+        # Only (annotation, room) pairs that touch can satisfy the overlap criterion.
+        annotation_is, room_is = STRtree(room_polys).query(annotation_polys, predicate="intersects")
+        intersections = shapely.intersection(room_polys[room_is], annotation_polys[annotation_is])
+        annotation_areas = shapely.area(annotation_polys[annotation_is])
+        assigned = (shapely.get_type_id(intersections) == GeometryType.POLYGON) & \
+                   (np.abs(shapely.area(intersections) - annotation_areas) < annotation_areas * conf.parser_config.room_label_assignment_overlap)
+
+        # Assign in room order, then annotation order.
+        for pair_i in np.lexsort((annotation_is, room_is)):
+            if assigned[pair_i]:
+                self.room_description_map[room_keys[room_is[pair_i]]].annotations.append(annotations[annotation_is[pair_i]])
+
+    def get_scaled_positions(self) -> dict:
+        """
+        Scale every corner position of the wall graph to real world units once.
+        The result is cached until a corner changes, which also resets wall_graph.positions, so all rooms share it.
+        :return: Mapping from corner position -> position multiplied by multiplication_factor.
+        """
+        mf = self.multiplication_factor
+        positions = self.wall_graph.positions
+        if self._scaled_positions is not None and self._scaled_positions[0] is positions and self._scaled_positions[1] == mf:
+            return self._scaled_positions[2]
+
+        corners = self.wall_graph.corners
+        if isinstance(mf, float):
+            # Scale the columnar positions array in one multiply. Matches scaling each coordinate in Python, since int coordinates are exact as floats.
+            scaled = {corner.pos: (x, y) for corner, (x, y) in zip(corners, (positions * mf).tolist())}
+        else:
+            # Keep int coordinates as ints when the factor is an int.
+            scaled = {corner.pos: (corner.pos[0] * mf, corner.pos[1] * mf) for corner in corners}
+        self._scaled_positions = (positions, mf, scaled)
+        return scaled
 
-    def get_room_json(self, conf: ConfigManager, room_key, include_walls: bool, skip_walls: dict = None, adjust_short_walls=False) -> tuple:
+    def get_room_json(self, conf: ConfigManager, room_key, include_walls: bool, skip_walls: dict = None, adjust_short_walls=False,
+                      scaled_positions: dict = None, precomputed: dict = None, return_extras: bool = True):
         """
         Obtain a json describing a room.
         :param conf: ConfigManager
@@ -539,15 +671,21 @@ class House:
         :param include_walls: Specify true to include walls in the results
         :param skip_walls: Dictionary of walls that are already generated. These walls will be skipped.
         :param adjust_short_walls: Specify true to make certain walls short. (E.g. balconies)
-        :return: Tuple of (An arch.json file describing the room, dictionary of newly added walls)
+        :param scaled_positions: Mapping from corner position -> scaled position, as returned by get_scaled_positions.
+        :param precomputed: Arch.json of the room previously generated with include_walls and no skipped walls, using the same adjust_short_walls.
+        Its elements are reused instead of generating them again.
+        :param return_extras: Specify false to only return the arch.json, without collecting the newly added walls.
+        :return: Tuple of (An arch.json file describing the room, dictionary of newly added walls). Only the arch.json if return_extras is false.
         """
         if skip_walls is None:
             skip_walls = {}
+        if scaled_positions is None:
+            scaled_positions = self.get_scaled_positions()
 
         added_walls = {}
         room_walls = self.room_description_map[room_key].walls
         room_id = self.room_description_map[room_key].room_id
-        polyline = get_polyline(room_walls)
+        polyline = self.room_description_map[room_key].polyline
 
         # Detect balcony rooms
         is_short_walled = False
@@ -557,13 +695,23 @@ class House:
                     is_short_walled = True
                     break
 
-        ceiling = generate_ceiling_json(conf, polyline, room_id, self.multiplication_factor)
-
-        floor = generate_floor_json(conf, polyline, room_id, self.multiplication_factor)
+        if precomputed is not None:
+            # Elements of a precomputed room json are the ceiling, the floor and then one wall per room wall.
+            ceiling, floor = precomputed["elements"][:2]
+            precomputed_walls = precomputed["elements"][2:]
+        else:
+            ceiling = generate_ceiling_json(conf, polyline, room_id, self.multiplication_factor, scaled_positions)
+            floor = generate_floor_json(conf, polyline, room_id, self.multiplication_factor, scaled_positions)
         elements = [ceiling, floor]
         if include_walls:
             for i_wall, wall in enumerate(room_walls):
-                if wall not in skip_walls:
+                if wall not in skip_walls and precomputed is not None:
+                    # roomId is extended by rooms sharing the wall, so give the wall json its own list.
+                    wall_json = dict(precomputed_walls[i_wall], roomId=[room_id])
+                    elements.append(wall_json)
+                    if return_extras:
+                        added_walls[wall] = wall_json
+                elif wall not in skip_walls:
                     # Check whether wall direction is needed to be swapped
                     next_wall = room_walls[(i_wall + 1) % len(room_walls)]
 
@@ -582,15 +730,16 @@ class House:
 
                     wall_json = generate_wall_json(conf, wall, room_id, self.multiplication_factor,
                                                    should_swap_wall_endpoints=should_swap_wall_endpoints,
-                                                   is_short_walled=is_short_walled)
+                                                   is_short_walled=is_short_walled, scaled_positions=scaled_positions)
                     elements.append(wall_json)
-                    added_walls[wall] = wall_json
+                    if return_extras:
+                        added_walls[wall] = wall_json
                 else:
                     skip_walls[wall]["roomId"].append(room_id)
 
         result = {
             "version": conf.arch_defaults.version,  # // Version
-            "id": osp.splitext(osp.dirname(self.file_name))[0] + "_room_" + str(self.ordered_rooms.index(room_key)),  # // Scene ID
+            "id": self.scene_id + "_room_" + str(self._room_indices[room_key]),  # // Scene ID
             "up": conf.arch_defaults.up,  # // Up vector (same as in house file)
             "front": conf.arch_defaults.front,  # // Front vector (same as in house file)
             "scaleToMeters": conf.arch_defaults.scale_to_meters,
@@ -609,41 +758,53 @@ class House:
             },
             "elements": elements,
         }
+        if not return_extras:
+            return result
         return result, added_walls
 
+    def allocate_element_ids(self) -> None:
+        """
+        Allocate ids of all walls and holes, in the order get_room_json would allocate them when called for each room in ordered_rooms.
+        Call before exporting rooms from separate processes, so that every process uses the same ids.
+        """
+        for room_key in self.ordered_rooms:
+            rd = self.room_description_map[room_key]
+            for wall in rd.walls:
+                for hole in wall.holes:
+                    hole.id
+                generate_wall_id(rd.room_id, wall)
+
     def get_objectaabb_json(self, conf: ConfigManager) -> dict:
         """
         Generate jsons describing object aabbs.
         :param conf: Config Manager
         :return: objectaabb.json file.
         """
+        # Scale all AABBs at once. The array keeps the input dtype, so int coordinates with an int factor stay ints.
+        scaled = (np.array([(obj.p1[0], obj.p1[1], obj.p2[0], obj.p2[1]) for obj in self.object_annotations]).reshape(-1, 4)
+                  * self.multiplication_factor).tolist()
         result_objects = []
-        for obj in self.object_annotations:
+        for obj, (x1, y1, x2, y2) in zip(self.object_annotations, scaled):
             result_objects.append({
                 "type": obj.type,
                 "bound_box": {
-                    "p1": [
-                        obj.p1[0] * self.multiplication_factor,
-                        obj.p1[1] * self.multiplication_factor
-                    ],
-                    "p2": [
-                        obj.p2[0] * self.multiplication_factor,
-                        obj.p2[1] * self.multiplication_factor
-                    ]
+                    "p1": [x1, y1],
+                    "p2": [x2, y2]
                 }
             })
         return {
             "objects": result_objects,
         }
 
-    def get_scene_json(self, conf: ConfigManager, adjust_short_walls: bool) -> dict:
+    def get_scene_json(self, conf: ConfigManager, adjust_short_walls: bool, precomputed_rooms: dict = None) -> dict:
         """
         Get a scene.json describing the house.
         :param conf: ConfigManager
         :param adjust_short_walls: Specify true to keep certain walls short (e.g. balconies)
+        :param precomputed_rooms: Optional mapping from room_key -> room json. Refer to get_arch_json.
         :return: Scene.json file
         """
-        arch_json = self.get_arch_json(conf, adjust_short_walls=adjust_short_walls)
+        arch_json = self.get_arch_json(conf, adjust_short_walls=adjust_short_walls, precomputed_rooms=precomputed_rooms)
         filtered_arch_json = {"elements": arch_json["elements"], "defaults": arch_json["defaults"], "rooms": arch_json["rooms"], "rdr": arch_json["rdr"],
                               "id": arch_json["id"]}
         result = {
@@ -662,11 +823,13 @@ class House:
         }
         return result
 
-    def get_arch_json(self, conf: ConfigManager, adjust_short_walls):
+    def get_arch_json(self, conf: ConfigManager, adjust_short_walls, precomputed_rooms: dict = None):
         """
         Get an arch.json describing the house.
         :param conf: ConfigManager
         :param adjust_short_walls: Specify true to keep certain walls short (e.g. balconies)
+        :param precomputed_rooms: Optional mapping from room_key -> room json returned by get_room_json(conf, room_key, True, [], adjust_short_walls).
+        Elements of these rooms are reused instead of generating them again.
         :return: arch.json file
         """
         elements = []
@@ -675,20 +838,17 @@ class House:
         # Move the balcony to the last in room_keys so that it will only assigned with the external walls
         room_keys = list(self.room_description_map.keys())
         if adjust_short_walls:
-            short_wall_list = []
-            for i, k in enumerate(room_keys):
-                for t in self.room_description_map[k].room_types:
-                    if t.type in conf.arch_defaults.short_wall_room_types:
-                        short_wall_list.append(k)
-                        break
-            for b in short_wall_list:
-                room_keys.remove(b)
-                room_keys.append(b)
+            short_wall_room_types = set(conf.arch_defaults.short_wall_room_types)
+            is_short_walled = {k: any(t.type in short_wall_room_types for t in rd.room_types) for k, rd in self.room_description_map.items()}
+            room_keys = [k for k in room_keys if not is_short_walled[k]] + [k for k in room_keys if is_short_walled[k]]
 
         # Populate room description jsons
+        scaled_positions = self.get_scaled_positions()
         room_description_jsons = []
         for room_key in room_keys:
-            room_json, used_walls = self.get_room_json(conf, room_key, True, skip_walls, adjust_short_walls=adjust_short_walls)
+            room_json, used_walls = self.get_room_json(conf, room_key, True, skip_walls, adjust_short_walls=adjust_short_walls,
+                                                       scaled_positions=scaled_positions,
+                                                       precomputed=precomputed_rooms.get(room_key) if precomputed_rooms is not None else None)
 
             # Update skip walls
             for k, v in used_walls.items():
@@ -714,7 +874,7 @@ class House:
 
         result = {
             "version": conf.arch_defaults.version,  # // Version
-            "id": osp.splitext(osp.dirname(self.file_name))[0],  # // Scene ID
+            "id": self.scene_id,  # // Scene ID
             "up": conf.arch_defaults.up,  # // Up vector (same as in house file)
             "front": conf.arch_defaults.front,  # // Front vector (same as in house file)
             "scaleToMeters": conf.arch_defaults.scale_to_meters,  # // What unit the architecture is specified in (same as in house file)
@@ -743,7 +903,7 @@ class House:
         :param path: Path to save output sketch.
         """
 
-        fnt = ImageFont.truetype(conf.data_paths.pil_font.path, conf.data_paths.pil_font.size)
+        fnt = _load_font(conf.data_paths.pil_font.path, conf.data_paths.pil_font.size)
 
         image = Image.new('RGB', (self.x_max - self.x_min + 2 * RAW_SKETCH_MARGIN, self.y_max - self.y_min + 2 * RAW_SKETCH_MARGIN))
         offset_x = -self.x_min + RAW_SKETCH_MARGIN
@@ -752,33 +912,46 @@ class House:
         for wall in self.walls:
             draw.line((wall["x_min"] + offset_x, wall["y_min"] + offset_y, wall["x_max"] + offset_x, wall["y_max"] + offset_y), fill=RAW_WALL_COLOR)
 
-        for entrance in self.entrances:
-            draw.rectangle((entrance["x_min"] + offset_x, entrance["y_min"] + offset_y, entrance["x_max"] + offset_x, entrance["y_max"] + offset_y),
-                           fill=RAW_ENTRANCE_COLOR)
-            draw.text(
-                (offset_x + (entrance["x_min"] + entrance["x_max"]) / 2, offset_y + (entrance["y_min"] + entrance["y_max"]) / 2),
-                entrance["category"],
-                font=fnt, fill=RAW_LABEL_COLOR)
-
-        for stair in self.stairs:
-            draw.rectangle((offset_x + stair["x_min"], offset_y + stair["y_min"], offset_x + stair["x_max"], offset_y + stair["y_max"]),
-                           fill=RAW_STAIR_COLOR)
-            draw.text(
-                (offset_x + (stair["x_min"] + stair["x_max"]) / 2, offset_y + (stair["y_min"] + stair["y_max"]) / 2),
-                stair["category"],
-                font=fnt, fill=RAW_LABEL_COLOR)
-
-        for raw_object in self.raw_objects:
-            draw.rectangle((offset_x + raw_object["x_min"], offset_y + raw_object["y_min"], offset_x + raw_object["x_max"], offset_y + raw_object["y_max"]),
-                           fill=RAW_OBJECT_COLOR)
-            draw.text((offset_x + (raw_object["x_min"] + raw_object["x_max"]) / 2, offset_y + (raw_object["y_min"] + raw_object["y_max"]) / 2),
-                      raw_object["category"],
-                      font=fnt, fill=RAW_LABEL_COLOR)
+        # Fill the axis aligned boxes straight into the pixel array, in the same order as they used to be drawn. Each label used to be drawn
+        # right after its box, so later boxes may cover it. Labels are held back until a later box overlaps them, which keeps that layering.
+        pixels = np.array(image)
+        pending_labels = []
+        for items, color in [(self.entrances, RAW_ENTRANCE_COLOR), (self.stairs, RAW_STAIR_COLOR), (self.raw_objects, RAW_OBJECT_COLOR)]:
+            for item in items:
+                x_min, y_min = offset_x + item["x_min"], offset_y + item["y_min"]
+                x_max, y_max = offset_x + item["x_max"], offset_y + item["y_max"]
+                # Anti-aliased glyphs may spill a pixel past the text bounding box, so the overlap test is padded.
+                if any(x_min <= r + 1 and x_max >= l - 1 and y_min <= b + 1 and y_max >= t - 1 for (l, t, r, b), _, _ in pending_labels):
+                    pixels = self._draw_raw_labels(pixels, pending_labels, fnt)
+                    pending_labels = []
+                pixels[y_min:y_max + 1, x_min:x_max + 1] = color
+                position = (offset_x + (item["x_min"] + item["x_max"]) / 2, offset_y + (item["y_min"] + item["y_max"]) / 2)
+                pending_labels.append((draw.textbbox(position, item["category"], font=fnt), position, item["category"]))
+        pixels = self._draw_raw_labels(pixels, pending_labels, fnt)
+        image = Image.fromarray(pixels)
+        draw = ImageDraw.Draw(image)
 
         for door in self.openings:
             draw.line((offset_x + door["x_min"], offset_y + door["y_min"], offset_x + door["x_max"], offset_y + door["y_max"]), fill=RAW_DOOR_COLOR)
         image.save(path)
 
+    @staticmethod
+    def _draw_raw_labels(pixels: np.ndarray, labels: list, fnt) -> np.ndarray:
+        """
+        Draw labels of raw annotations on a pixel array.
+        :param pixels: Pixel array of the sketch.
+        :param labels: List of (bounding box, position, label text).
+        :param fnt: Font used for the labels.
+        :return: Pixel array with the labels drawn.
+        """
+        if not labels:
+            return pixels
+        image = Image.fromarray(pixels)
+        draw = ImageDraw.Draw(image)
+        for _, position, label in labels:
+            draw.text(position, label, font=fnt, fill=RAW_LABEL_COLOR)
+        return np.array(image)
+
     def sketch_room_annotations(self, conf: ConfigManager, room_key, path: str):
         """
         Sketch annotations of a room.
@@ -786,7 +959,7 @@ class House:
         :param room_key: Key of interested room
         :param path: Path to save sketch
         """
-        fnt = ImageFont.truetype(conf.data_paths.pil_font.path, conf.data_paths.pil_font.size)
+        fnt = _load_font(conf.data_paths.pil_font.path, conf.data_paths.pil_font.size)
 
         offset_x = -self.x_min + ROOM_SKETCH_MARGIN
         offset_y = -self.y_min + ROOM_SKETCH_MARGIN
@@ -794,7 +967,7 @@ class House:
         image = Image.new('RGB', (self.x_max - self.x_min + 2 * ROOM_SKETCH_MARGIN, self.y_max - self.y_min + 2 * ROOM_SKETCH_MARGIN))
         draw = ImageDraw.Draw(image)
 
-        polyline = get_polyline(self.room_description_map[room_key].walls)
+        polyline = self.room_description_map[room_key].polyline
         polyline = [(a[0] + offset_x, a[1] + offset_y) for a in polyline]
         draw.polygon(polyline, fill=ROOM_SKETCH_SELECTED_ROOM_COLOR, outline=None)
 
@@ -802,7 +975,7 @@ class House:
         neighbour_candidates = [a for a in self.rdr if a[0] == room_key]
         for _, _, neighbour_candidate in neighbour_candidates:
             if neighbour_candidate is not None:
-                neighbour_polyline = get_polyline(self.room_description_map[neighbour_candidate].walls)
+                neighbour_polyline = self.room_description_map[neighbour_candidate].polyline
                 neighbour_polyline = [(a[0] + offset_x, a[1] + offset_y) for a in neighbour_polyline]
                 draw.polygon(neighbour_polyline, fill=ROOM_SKETCH_DOOR_CONNECTED_ADJACENT_ROOM_COLOR, outline=None)
 
@@ -826,30 +999,26 @@ class House:
         """
         # Identify room types of each room
         for room_key, rd in self.room_description_map.items():
+            walls = rd.walls
             room_type_candidates = []
-            for i_wall, wall in enumerate(rd.walls):
-                next_wall = rd.walls[(i_wall + 1) % len(rd.walls)]
-
-                next_wall_connection = None
-                if next_wall.p1 == wall.p1 or next_wall.p1 == wall.p2:
+            for wall, next_wall in zip(walls, walls[1:] + walls[:1]):
+                ends = (wall.p1, wall.p2)
+                if next_wall.p1 in ends:
                     next_wall_connection = next_wall.p1
-                elif next_wall.p2 == wall.p1 or next_wall.p2 == wall.p2:
+                elif next_wall.p2 in ends:
                     next_wall_connection = next_wall.p2
                 else:
                     assert False
 
                 if wall.p2 != next_wall_connection:
-                    should_swap_wall_endpoints = True
                     room_type_candidates.append(wall.left_room_type)
                 else:
-                    should_swap_wall_endpoints = False
                     room_type_candidates.append(wall.right_room_type)
-                # print(should_swap_wall_endpoints)
-            room_type_candidates = list(set(room_type_candidates))
+            room_type_candidates = list(dict.fromkeys(room_type_candidates))
             # assert len(room_type_candidates) == 1  # Test for consistent room type assignment
             assert room_type_candidates[0] != "outside"
 
-            rd.room_id = generate_room_id(room_key, self.ordered_rooms)
+            rd.room_id = generate_room_id(room_key, self._room_indices[room_key])
             rd.room_types = [AABBAnnotation(a) for a in room_type_candidates]
 
     def populate_room_descriptions_from_r2v_annot(self, conf: ConfigManager) -> None:
@@ -858,7 +1027,7 @@ class House:
         :param conf: ConfigManager
         """
         for room_key, rd in self.room_description_map.items():
-            rd.room_id = generate_room_id(room_key, self.ordered_rooms)
+            rd.room_id = generate_room_id(room_key, self._room_indices[room_key])
             for annotation in rd.annotations:
                 if annotation.type in conf.room_types:
                     rd.room_types.append(annotation)
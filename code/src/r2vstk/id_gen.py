@@ -1,24 +1,25 @@
-from random import Random
+from itertools import count
 import hashlib
 
-from r2vstk.constants import RAND_MAX
-
-ran = Random()
+# Monotonic counters, so generated ids never collide within a process.
+_hole_counter = count()
+_wall_counter = count()
 
 
 def generate_hole_id() -> str:
     """
     Generate id for a hole.
     """
-    return "hole_" + str(ran.randint(0, RAND_MAX))
+    return "hole_" + str(next(_hole_counter))
 
 
-def generate_room_id(room_key, ordered_rooms):
+def generate_room_id(room_key, room_index: int):
     """
     Generate id for a room.
+    :param room_key: Key of the room.
+    :param room_index: Index of the room in House.ordered_rooms.
     """
-    hash_object = hashlib.md5(str(room_key).encode("utf-8"))
-    return "room_" + str(ordered_rooms.index(room_key)) + "_" + hash_object.hexdigest()
+    return "room_" + str(room_index) + "_" + hashlib.md5(str(room_key).encode("utf-8")).hexdigest()
 
 
 def generate_wall_id(room_id, wall):
@@ -27,5 +28,5 @@ def generate_wall_id(room_id, wall):
     """
     if wall.id is not None:
         return wall.id
-    wall.id = room_id + "_wall" + str(ran.randint(0, RAND_MAX))
+    wall.id = room_id + "_wall" + str(next(_wall_counter))
     return wall.id
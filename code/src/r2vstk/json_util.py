@@ -1,17 +1,77 @@
+import copy
 import json
 import logging
-import copy
 
 from r2vstk.config_manager import ConfigManager
+from r2vstk.constants import JSON_WRITE_BUFFER_SIZE
 from r2vstk.floorplan import Wall
 from r2vstk.id_gen import generate_wall_id
 import math
+import numpy as np
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 log = logging.getLogger(__name__)
 
 
+def dumps_json(data, pretty: bool = True) -> bytes:
+    """
+    Serialize data to UTF-8 encoded json.
+    Indented json always uses the standard json module with an indent of 3. Compact json uses orjson when it is installed.
+    :param data: Json data.
+    :param pretty: Specify true to indent the json. Otherwise, the json is compact.
+    :return: Serialized json.
+    """
+    if pretty:
+        return json.dumps(data, indent=3).encode("utf-8")
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(data, separators=(",", ":")).encode("utf-8")
+
+
+def save_json(data, path: str, pretty: bool = True) -> None:
+    """
+    Save data to a json file.
+    :param data: Json data.
+    :param path: Save path.
+    :param pretty: Specify true to indent the json. Otherwise, the json is compact.
+    """
+    if pretty:
+        # Indented output is encoded in Python, so stream it to the file instead of building the whole string first.
+        # json.dump issues a write per token, so a large buffer keeps the number of write calls down.
+        with open(path, "w", buffering=JSON_WRITE_BUFFER_SIZE) as f:
+            json.dump(data, f, indent=3)
+    else:
+        with open(path, "wb") as f:
+            f.write(dumps_json(data, pretty=False))
+
+
+def copy_materials(materials: list) -> list:
+    """
+    Copy a list of materials so that the copy can be edited independently.
+    Materials are flat dicts, which only need a dict copy. Anything else is deep copied.
+    """
+    return [dict(m) if isinstance(m, dict) else copy.deepcopy(m) for m in materials]
+
+
+def scale_points(points, multiplication_factor: float, scaled_positions: dict = None) -> list:
+    """
+    Scale 2D points to real world units.
+    :param points: List of 2D points.
+    :param multiplication_factor: Scale factor to real world units
+    :param scaled_positions: Optional mapping from point -> scaled point, used instead of multiplying when given.
+    :return: List of scaled (x, z) tuples.
+    """
+    if scaled_positions is not None:
+        return [scaled_positions[p] for p in points]
+    return [(p[0] * multiplication_factor, p[1] * multiplication_factor) for p in points]
+
+
 def generate_wall_json(conf: ConfigManager, wall: Wall, room_id: str,  multiplication_factor: float, should_swap_wall_endpoints: bool,
-                       is_short_walled: bool = False) -> dict:
+                       is_short_walled: bool = False, scaled_positions: dict = None) -> dict:
     """
     Generate a json describing a wall.
     :param conf: ConfigManager
@@ -21,47 +81,40 @@ def generate_wall_json(conf: ConfigManager, wall: Wall, room_id: str,  multiplic
     :param multiplication_factor: Scale factor to real world units
     :param should_swap_wall_endpoints: Should the endpoints of the wall swap.
     :param is_short_walled: Specify true to make the wall short.
+    :param scaled_positions: Optional mapping from corner position -> position scaled by multiplication_factor.
     :return: Wall json
     """
-    hole_jsons = []
-    old_wall_width = math.sqrt((wall.p2.pos[1] - wall.p1.pos[1]) ** 2 + (wall.p2.pos[0] - wall.p1.pos[0]) ** 2)
-    new_wall_width = math.sqrt(((wall.p2.pos[1] * multiplication_factor) - (wall.p1.pos[1] * multiplication_factor)) ** 2 +
-                               ((wall.p2.pos[0] * multiplication_factor) - (wall.p1.pos[0] * multiplication_factor)) ** 2)
-
-    wall_p1 = wall.p1
-    wall_p2 = wall.p2
+    p1 = wall.p1.pos
+    p2 = wall.p2.pos
+    if should_swap_wall_endpoints:
+        p1, p2 = p2, p1
+    (p1x, p1z), (p2x, p2z) = scale_points((p1, p2), multiplication_factor, scaled_positions)
 
+    # Hole extents are distances along the wall, so they scale by the magnitude of multiplication_factor. Wall points keep its sign.
+    hole_extents = np.array([(hole.min_x, hole.max_x) for hole in wall.holes], dtype=np.float64).reshape(-1, 2)
     if should_swap_wall_endpoints:
-        wall_p1, wall_p2 = wall_p2, wall_p1
-
-    for hole in wall.holes:
-        hole_minx = hole.min_x
-        hole_maxx = hole.max_x
-        if should_swap_wall_endpoints:
-            hole_minx, hole_maxx = old_wall_width - hole_maxx, old_wall_width - hole_minx
-
-        hole_type = None
-        # Load defaults since we do not have a model
-        min_y = conf.arch_defaults.door_min_y
-        max_y = conf.arch_defaults.door_max_y
-
-        if hole.type == "door":
-            hole_type = "Door"
-            min_y = conf.arch_defaults.door_min_y
-            max_y = conf.arch_defaults.door_max_y
-        elif hole.type == "window":
-            hole_type = "Window"
-            min_y = conf.arch_defaults.window_min_y
-            max_y = conf.arch_defaults.window_max_y
+        old_wall_width = math.sqrt((wall.p2.pos[1] - wall.p1.pos[1]) ** 2 + (wall.p2.pos[0] - wall.p1.pos[0]) ** 2)
+        hole_extents = old_wall_width - hole_extents[:, ::-1]
+    hole_extents = (hole_extents * abs(multiplication_factor)).tolist()
+
+    # Load defaults since we do not have a model. Untyped holes use door heights.
+    door_y = (conf.arch_defaults.door_min_y, conf.arch_defaults.door_max_y)
+    window_y = (conf.arch_defaults.window_min_y, conf.arch_defaults.window_max_y)
+    hole_types = {"door": ("Door", door_y), "window": ("Window", window_y)}
+    default_hole_type = (None, door_y)
+
+    hole_jsons = []
+    for hole, (hole_minx, hole_maxx) in zip(wall.holes, hole_extents):
+        hole_type, (min_y, max_y) = hole_types.get(hole.type, default_hole_type)
 
         hole_json = {
             "id": hole.id,  # Node id of object creating hole in the wall
             "type": hole_type,  # hole type (`Door` or `Window`)
             "box": {  # cutout of hole as box on the wall
-                "min": [(hole_minx / old_wall_width * new_wall_width), min_y],  # minimum point
+                "min": [hole_minx, min_y],  # minimum point
                 # x is distance from points[0] (toward points[1])
                 # y is height from wall bottom (goes from 0 to wall height)
-                "max": [(hole_maxx / old_wall_width * new_wall_width), max_y]  # maximum point
+                "max": [hole_maxx, max_y]  # maximum point
             }
         }
         hole_jsons.append(hole_json)
@@ -70,30 +123,30 @@ def generate_wall_json(conf: ConfigManager, wall: Wall, room_id: str,  multiplic
         "roomId": [room_id],
         "id": generate_wall_id(room_id, wall),
         "type": "Wall",
-        "points": [[(wall_p1.pos[0] * multiplication_factor), 0.0, (wall_p1.pos[1] * multiplication_factor)],
-                   [(wall_p2.pos[0] * multiplication_factor), 0.0, (wall_p2.pos[1] * multiplication_factor)]],
+        "points": [[p1x, 0.0, p1z], [p2x, 0.0, p2z]],
         "holes": hole_jsons,
         "height": conf.arch_defaults.wall_height if not is_short_walled else conf.arch_defaults.short_wall_height,
-        "materials": copy.deepcopy(conf.arch_defaults.wall_materials),
+        "materials": copy_materials(conf.arch_defaults.wall_materials),
         "depth": conf.arch_defaults.wall_depth,
         "extra_height": conf.arch_defaults.wall_extra_height
     }
     return wall_json
 
 
-def generate_ceiling_json(conf: ConfigManager, polyline, room_id: str, multiplication_factor: float) -> dict:
+def generate_ceiling_json(conf: ConfigManager, polyline, room_id: str, multiplication_factor: float, scaled_positions: dict = None) -> dict:
     """
     Generate a json describing a ceiling.
     :param conf: ConfigManager
     :param polyline: Outline of the room
     :param room_id: id of the room
     :param multiplication_factor: Scale factor to real-world
+    :param scaled_positions: Optional mapping from polyline point -> point scaled by multiplication_factor.
     :return: Json description of the ceiling
     """
     r = {
         "id": room_id + "_c",
         "roomId": room_id,
-        "points": [[[(p[0] * multiplication_factor), 0.0, (p[1] * multiplication_factor)] for p in polyline]],
+        "points": [[[x, 0.0, z] for x, z in scale_points(polyline, multiplication_factor, scaled_positions)]],
         "type": "Ceiling",
         "materials": conf.arch_defaults.ceiling_materials[:],
         "offset": [0.0, conf.arch_defaults.wall_height, 0.0],
@@ -102,19 +155,20 @@ def generate_ceiling_json(conf: ConfigManager, polyline, room_id: str, multiplic
     return r
 
 
-def generate_floor_json(conf: ConfigManager, polyline, room_id:str, multiplication_factor:float):
+def generate_floor_json(conf: ConfigManager, polyline, room_id:str, multiplication_factor:float, scaled_positions: dict = None):
     """
     Generate a json describing the floor surface
     :param conf: ConfigManager
     :param polyline: Outline of the room
     :param room_id: id of the room
     :param multiplication_factor: Scale factor to real-world
+    :param scaled_positions: Optional mapping from polyline point -> point scaled by multiplication_factor.
     :return: Json description of the floor.
     """
     r = {
         "id": room_id + "_f",
         "roomId": room_id,
-        "points": [[[(p[0] * multiplication_factor), 0.0, (p[1] * multiplication_factor)] for p in polyline]],
+        "points": [[[x, 0.0, z] for x, z in scale_points(polyline, multiplication_factor, scaled_positions)]],
         "type": "Floor",
         "materials": conf.arch_defaults.floor_materials[:],
         "depth": conf.arch_defaults.floor_depth
@@ -1,8 +1,15 @@
+from shapely.geometry import Polygon
+
+from r2vstk.util import get_polyline_corners
+
+
 class RoomDescription:
     """
     Describes a room.
     """
 
+    __slots__ = ('_room_key', '_room_id', 'walls', '_room_types', 'wall_ids_map', 'annotations', '_polyline_corners', '_polygon')
+
     def __init__(self, room_key: frozenset, walls: list, room_id: str = None):
         """
         Initialize room description
@@ -12,18 +19,12 @@ class RoomDescription:
 
         self._room_key = room_key
         self._room_id = room_id
-        self._walls = walls
+        self.walls = walls
         self._room_types = []
-        self._wall_ids_map = {}  # Mapping from wall to wall id
-        self._annotations = []  # Annotation AABBs assigned to the room
-
-    @property
-    def annotations(self) -> list:
-        return self._annotations
-
-    @property
-    def wall_ids_map(self):
-        return self._wall_ids_map
+        self.wall_ids_map = {}  # Mapping from wall to wall id
+        self.annotations = []  # Annotation AABBs assigned to the room
+        self._polyline_corners = None  # Corners along the room polyline. Depends only on wall connectivity.
+        self._polygon = None  # Cached (polyline, Polygon). Rebuilt when a corner of the room has moved.
 
     @property
     def room_id(self) -> str:
@@ -35,8 +36,30 @@ class RoomDescription:
         self._room_id = value
 
     @property
-    def walls(self) -> list:
-        return self._walls
+    def polyline(self) -> list:
+        """
+        Positions of corners along the room boundary.
+        """
+        if self._polyline_corners is None:
+            self._polyline_corners = get_polyline_corners(self.walls)
+        return [c.pos for c in self._polyline_corners]
+
+    @property
+    def polygon(self) -> Polygon:
+        """
+        Room boundary as a shapely polygon.
+        """
+        polyline = self.polyline
+        if self._polygon is None or len(self._polygon[0]) != len(polyline) or any(a is not b for a, b in zip(self._polygon[0], polyline)):
+            self._polygon = (polyline, Polygon(polyline))
+        return self._polygon[1]
+
+    def invalidate(self) -> None:
+        """
+        Drop the cached polyline and polygon. Call after the walls of the room are changed.
+        """
+        self._polyline_corners = None
+        self._polygon = None
 
     @property
     def room_types(self) -> list:
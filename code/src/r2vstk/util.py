@@ -10,70 +10,81 @@ def find_angle(p):
     """
     assert isinstance(p, tuple)
     assert len(p) == 2
-    h = math.sqrt(p[0] ** 2 + p[1] ** 2)
-    ang = math.acos(p[0] / h) * 180 / math.pi
-    if p[1] > 0:
-        ang = -ang
-    return ang
+    # Negate y since positive y is down. 0.0 - y keeps a zero y positive, so that the negative x axis maps to 180 rather than -180.
+    return math.degrees(math.atan2(0.0 - p[1], p[0]))
 
 
 def find_angle_between(p1, p2):
     """
-    Find angle between two 2d vectors p1 and p2.
+    Find angle between two 2d vectors p1 and p2, measured counter clockwise from p1 to p2.
+    :return: Angle in degrees, in the range [0, 360).
     """
-    a2 = find_angle(p2)
-    a1 = find_angle(p1)
-    if a1 < 0:
-        a1 = 360 + a1
-    if a2 < 0:
-        a2 = 360 + a2
+    return (find_angle(p2) - find_angle(p1)) % 360
 
-    return a2 - a1
+
+def _wall_angles(vertex) -> list:
+    """
+    Angle of each wall adjacent to a vertex, measured at the vertex towards the other end of the wall.
+    :return: List of (angle, wall) in vertex.adj order.
+    """
+    wall_angles = []
+    for wall in vertex.adj:
+        other = wall.p1
+        if other == vertex:
+            other = wall.p2
+        wall_angles.append((find_angle((other.pos[0] - vertex.pos[0], other.pos[1] - vertex.pos[1])), wall))
+    return wall_angles
 
 
-def _find_next_wall(vertex, in_wall):
+def _find_next_wall(vertex, in_wall, wall_angle_cache: dict = None):
     """
     Wall along the in-wall upto vertex and choose the next wall going out from the vertex.
+    The next wall is the one with the smallest counter clockwise angle from the in-wall. Ties go to the first in vertex.adj.
+    :param wall_angle_cache: Optional mapping from vertex -> result of _wall_angles(vertex), shared across calls on an unchanged wall graph.
     """
     if len(vertex.adj) == 1:
         return None
-    else:
-        in_other = in_wall.p1
-        if in_other == vertex:
-            in_other = in_wall.p2
-        in_other_vector = (in_other.pos[0] - vertex.pos[0], in_other.pos[1] - vertex.pos[1])
-        #         print(in_other_vector)
-
-        walls_with_angles = []
 
-        for wall in vertex.adj:
-            if wall == in_wall:
-                continue
-            adj_other = wall.p1
-            if adj_other == vertex:
-                adj_other = wall.p2
-            adj_other_vector = (adj_other.pos[0] - vertex.pos[0], adj_other.pos[1] - vertex.pos[1])
-
-            angle_between = find_angle_between(in_other_vector, adj_other_vector)
-            if angle_between < 0:
-                angle_between += 360
-            walls_with_angles.append((angle_between, wall))
-            #             print(str(wall), adj_other_vector, angle_between)
-
-        walls_with_angles = sorted(walls_with_angles, key=lambda a: a[0])
-        return walls_with_angles[0][1]
+    if wall_angle_cache is None:
+        wall_angles = _wall_angles(vertex)
+    else:
+        wall_angles = wall_angle_cache.get(vertex)
+        if wall_angles is None:
+            wall_angles = wall_angle_cache[vertex] = _wall_angles(vertex)
+
+    in_angle = next(angle for angle, wall in wall_angles if wall == in_wall)
+    next_wall = None
+    next_angle = None
+    for angle, wall in wall_angles:
+        if wall == in_wall:
+            continue
+        angle_between = (angle - in_angle) % 360  # Same as find_angle_between
+        if next_angle is None or angle_between < next_angle:
+            next_angle = angle_between
+            next_wall = wall
+    return next_wall
 
 
-def find_room(start_node, start_wall):
+def find_room(start_node, start_wall, next_wall_cache: dict = None, wall_angle_cache: dict = None):
     """
     Detect a room given a vertex in the room and a wall adjacent to that vertex in the room.
+    :param next_wall_cache: Optional mapping from (vertex, in_wall) -> next wall, shared across calls on an unchanged wall graph.
+    :param wall_angle_cache: Optional mapping from vertex -> angles of adjacent walls, shared across calls on an unchanged wall graph.
     :return: List of walls in the found room.
     """
     walls = [start_wall]
     current_node = start_node
     iter_count = 0
     while iter_count < 500:
-        next_wall = _find_next_wall(current_node, walls[-1])
+        if next_wall_cache is None:
+            next_wall = _find_next_wall(current_node, walls[-1], wall_angle_cache)
+        else:
+            key = (current_node, walls[-1])
+            if key in next_wall_cache:
+                next_wall = next_wall_cache[key]
+            else:
+                next_wall = _find_next_wall(current_node, walls[-1], wall_angle_cache)
+                next_wall_cache[key] = next_wall
         if next_wall == walls[0]:
             return walls  # We have completed a cycle
 
@@ -132,9 +143,9 @@ def convert_int(str_num):
     """
     Convert string number to integer
     """
-    if str_num.isnumeric():
+    try:
         return int(str_num)
-    else:
+    except ValueError:
         return int(float(str_num))
 
 
@@ -185,29 +196,27 @@ def rect_line_distance(rect_p1, rect_p2, line_p1, line_p2):
     """
     Find distance between a rectangle and a line segment.
     """
-    c1 = (rect_p1[0], rect_p1[1])
-    c2 = (rect_p2[0], rect_p1[1])
-    c3 = (rect_p2[0], rect_p2[1])
-    c4 = (rect_p1[0], rect_p2[1])
-    cs = [c1, c2, c3, c4]
-    min_distance = sq_distance(c1, line_p1)
-    for c in cs:
-        min_distance = min(min_distance, sq_distance(c, line_p1))
-        min_distance = min(min_distance, sq_distance(c, line_p2))
+    # Compare squared distances and take a single square root of the smallest.
+    min_sq_distance = math.inf
+    for cx, cy in ((rect_p1[0], rect_p1[1]), (rect_p2[0], rect_p1[1]), (rect_p2[0], rect_p2[1]), (rect_p1[0], rect_p2[1])):
+        for lx, ly in (line_p1, line_p2):
+            d = (cx - lx) ** 2 + (cy - ly) ** 2
+            if d < min_sq_distance:
+                min_sq_distance = d
 
-    return min_distance
+    return math.sqrt(min_sq_distance)
 
 
 def hole_to_line(wall_p1, wall_p2, hole_start, hole_end):
     """
     Convert 1D on-wall coordinates to 2D world coordinates.
     """
-    distance = math.sqrt(float((wall_p2[0] - wall_p1[0]) ** 2 + (wall_p2[1] - wall_p1[1]) ** 2))
-    start_x = (wall_p2[0] - wall_p1[0]) / float(distance) * hole_start + wall_p1[0]
-    start_y = (wall_p2[1] - wall_p1[1]) / float(distance) * hole_start + wall_p1[1]
-    end_x = (wall_p2[0] - wall_p1[0]) / float(distance) * hole_end + wall_p1[0]
-    end_y = (wall_p2[1] - wall_p1[1]) / float(distance) * hole_end + wall_p1[1]
-    return (start_x, start_y), (end_x, end_y)
+    dx = wall_p2[0] - wall_p1[0]
+    dy = wall_p2[1] - wall_p1[1]
+    distance = math.sqrt(float(dx ** 2 + dy ** 2))
+    ux = dx / distance
+    uy = dy / distance
+    return (ux * hole_start + wall_p1[0], uy * hole_start + wall_p1[1]), (ux * hole_end + wall_p1[0], uy * hole_end + wall_p1[1])
 
 
 def line_contains_check(parent, child, pd_margin: bool):
@@ -230,16 +239,16 @@ def line_contains_check(parent, child, pd_margin: bool):
         #         print("PD2 failed", pd2)
         return False, None
 
-    # Now both are in same line
-    p1_c1_distance = math.sqrt((parent.p1.pos[0] - child.p1.pos[0]) ** 2 + (parent.p1.pos[1] - child.p1.pos[1]) ** 2)
-    p1_c2_distance = math.sqrt((parent.p1.pos[0] - child.p2.pos[0]) ** 2 + (parent.p1.pos[1] - child.p2.pos[1]) ** 2)
-    p2_c1_distance = math.sqrt((parent.p2.pos[0] - child.p1.pos[0]) ** 2 + (parent.p2.pos[1] - child.p1.pos[1]) ** 2)
-    p2_c2_distance = math.sqrt((parent.p2.pos[0] - child.p2.pos[0]) ** 2 + (parent.p2.pos[1] - child.p2.pos[1]) ** 2)
+    # Now both are in same line. Only the order of the end point distances matters, so compare squared distances.
+    p1_c1_sq_distance = (parent.p1.pos[0] - child.p1.pos[0]) ** 2 + (parent.p1.pos[1] - child.p1.pos[1]) ** 2
+    p1_c2_sq_distance = (parent.p1.pos[0] - child.p2.pos[0]) ** 2 + (parent.p1.pos[1] - child.p2.pos[1]) ** 2
+    p2_c1_sq_distance = (parent.p2.pos[0] - child.p1.pos[0]) ** 2 + (parent.p2.pos[1] - child.p1.pos[1]) ** 2
+    p2_c2_sq_distance = (parent.p2.pos[0] - child.p2.pos[0]) ** 2 + (parent.p2.pos[1] - child.p2.pos[1]) ** 2
 
-    if p1_c1_distance < p1_c2_distance and p2_c2_distance < p2_c1_distance:
+    if p1_c1_sq_distance < p1_c2_sq_distance and p2_c2_sq_distance < p2_c1_sq_distance:
         return True, min(pd1, pd2)
 
-    if p1_c2_distance < p1_c1_distance and p2_c1_distance < p2_c2_distance:
+    if p1_c2_sq_distance < p1_c1_sq_distance and p2_c1_sq_distance < p2_c2_sq_distance:
         return True, min(pd1, pd2)
 
     return False, None
@@ -249,42 +258,65 @@ def get_polyline(walls):
     """
     Generate polyline given a list of walls.
     """
-    points = []
-    points.append(walls[0].p1)
-    points.append(walls[0].p2)
-    unvisited_walls = list(walls[1:])
-    while len(unvisited_walls) > 0:
-        for i, w in enumerate(unvisited_walls):
-            if w.p1 == points[-1]:
-                del unvisited_walls[i]
-                points.append(w.p2)
-                break
-            elif w.p2 == points[-1]:
-                del unvisited_walls[i]
-                points.append(w.p1)
+    return [p.pos for p in get_polyline_corners(walls)]
+
+
+def get_polyline_corners(walls):
+    """
+    Generate the corners along the polyline of a list of walls.
+    """
+    points = [walls[0].p1, walls[0].p2]
+
+    # Mapping from corner -> indices of walls ending at that corner, in list order.
+    corner_walls = {}
+    for i in range(1, len(walls)):
+        corner_walls.setdefault(walls[i].p1, []).append(i)
+        corner_walls.setdefault(walls[i].p2, []).append(i)
+
+    visited = [False] * len(walls)
+    while True:
+        # Continue along the first unvisited wall in list order that ends at the last point.
+        for i in corner_walls.get(points[-1], ()):
+            if not visited[i]:
                 break
         else:
             break
+        visited[i] = True
+        w = walls[i]
+        points.append(w.p2 if w.p1 == points[-1] else w.p1)
 
-    return [p.pos for p in points]
+    return points
 
 
-def find_closest(target: tuple, other_nodes: list, cutoff_distance: float, exclude: list):
+def find_closest_grid(target: tuple, grid: dict, cutoff_distance: float, exclude: list):
     """
     Find closest and 2nd closest node to a target node subjected to a cutoff distance and an exclusion list.
+    Only nodes in the 3x3 grid cells around the target are visited.
+    :param grid: Mapping from (x // cutoff_distance, y // cutoff_distance) cell -> list of (insertion order, node). Ties in distance are
+    broken by insertion order.
     """
-    distance_tuples = []
-    for other_node in other_nodes.values():
-        if other_node in exclude:
-            continue
-        distance = manhattan_distance_between(other_node.pos, target)
-        if distance < cutoff_distance:
-            distance_tuples.append((distance, other_node))
-
-    distance_tuples = sorted(distance_tuples, key=lambda x: x[0])
-    if len(distance_tuples) > 1:
-        return distance_tuples[0][1], distance_tuples[1][1]
-    elif len(distance_tuples) == 1:
-        return distance_tuples[0][1], None
-    else:
+    target_x, target_y = target
+    cell_x = int(target_x // cutoff_distance)
+    cell_y = int(target_y // cutoff_distance)
+
+    # Track the two best (distance, insertion order, node) candidates in a single pass.
+    best = None
+    second = None
+    for x in range(cell_x - 1, cell_x + 2):
+        for y in range(cell_y - 1, cell_y + 2):
+            for order, other_node in grid.get((x, y), ()):
+                pos = other_node.pos
+                distance = max(abs(pos[0] - target_x), abs(pos[1] - target_y))
+                if distance >= cutoff_distance or other_node in exclude:
+                    continue
+                candidate = (distance, order, other_node)
+                if best is None or candidate[:2] < best[:2]:
+                    best, second = candidate, best
+                elif second is None or candidate[:2] < second[:2]:
+                    second = candidate
+
+    if best is None:
         return None, None
+    if second is None:
+        return best[2], None
+    return best[2], second[2]
@@ -1,16 +1,31 @@
 # This code assumes manhattan
 # Code adapted from https://github.com/art-programmer/FloorplanTransformation/
 
+# Maximum gap between two lines that are considered connected. Used by find_connections.
+CONNECTION_GAP = 5
+
 
 def find_connections(l1, l2, gap):
     if l1[0][0] == l1[1][0]:
-        r, p = _findConnections(l2, l1, gap=5)
+        r, p = _findConnections(l2, l1, gap=CONNECTION_GAP)
         r[0], r[1] = r[1], r[0]
     else:
-        r, p = _findConnections(l1, l2, gap=5)
+        r, p = _findConnections(l1, l2, gap=CONNECTION_GAP)
     return r, p
 
 
+def may_connect(l1, l2):
+    """
+    Cheap necessary condition for find_connections to connect two lines: their bounding boxes, grown by CONNECTION_GAP, overlap.
+    """
+    for axis in range(2):
+        min_1, max_1 = sorted((l1[0][axis], l1[1][axis]))
+        min_2, max_2 = sorted((l2[0][axis], l2[1][axis]))
+        if min_1 - max_2 > CONNECTION_GAP or min_2 - max_1 > CONNECTION_GAP:
+            return False
+    return True
+
+
 def lineRange(line):
     direction = calcLineDirection(line)
     fixedValue = (line[0][1 - direction] + line[1][1 - direction]) // 2
@@ -29,26 +44,23 @@ def pointDistance(point_1, point_2):
 
 
 def _findConnections(line_1, line_2, gap):
-    connection_1 = -1
-    connection_2 = -1
-    pointConnected = False
-    for c_1 in range(2):
-        if pointConnected:
-            break
-        for c_2 in range(2):
-            if pointDistance(line_1[c_1], line_2[c_2]) > gap:
-                continue
-
-            connection_1 = c_1
-            connection_2 = c_2
-            connectionPoint = ((line_1[c_1][0] + line_2[c_2][0]) // 2, (line_1[c_1][1] + line_2[c_2][1]) // 2)
-            pointConnected = True
-            break
-        continue
-    if pointConnected:
-        return [connection_1, connection_2], connectionPoint
-    direction_1, fixedValue_1, min_1, max_1 = lineRange(line_1)
-    direction_2, fixedValue_2, min_2, max_2 = lineRange(line_2)
+    # pointDistance and lineRange are inlined here, since this runs for every candidate wall pair.
+    (x1_0, y1_0), (x1_1, y1_1) = line_1
+    (x2_0, y2_0), (x2_1, y2_1) = line_2
+    for c_1, (px, py) in ((0, (x1_0, y1_0)), (1, (x1_1, y1_1))):
+        for c_2, (qx, qy) in ((0, (x2_0, y2_0)), (1, (x2_1, y2_1))):
+            if abs(px - qx) <= gap and abs(py - qy) <= gap:
+                return [c_1, c_2], ((px + qx) // 2, (py + qy) // 2)
+
+    if abs(x1_0 - x1_1) < abs(y1_0 - y1_1):
+        direction_1, fixedValue_1, min_1, max_1 = 1, (x1_0 + x1_1) // 2, min(y1_0, y1_1), max(y1_0, y1_1)
+    else:
+        direction_1, fixedValue_1, min_1, max_1 = 0, (y1_0 + y1_1) // 2, min(x1_0, x1_1), max(x1_0, x1_1)
+    if abs(x2_0 - x2_1) < abs(y2_0 - y2_1):
+        direction_2, fixedValue_2, min_2, max_2 = 1, (x2_0 + x2_1) // 2, min(y2_0, y2_1), max(y2_0, y2_1)
+    else:
+        direction_2, fixedValue_2, min_2, max_2 = 0, (y2_0 + y2_1) // 2, min(x2_0, x2_1), max(x2_0, x2_1)
+
     if direction_1 == direction_2:
         return [-1, -1], (0, 0)
 
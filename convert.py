@@ -1,17 +1,63 @@
 import logging
+from config_parser import Config
 from r2vstk.config_manager import ConfigManager
 from r2vstk.house import House
+from r2vstk.json_util import save_json
 import argparse
-import os.path
+import hashlib
 import json
+import multiprocessing
+import os
+import os.path
+import shutil
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+# Rooms are exported by a process pool only when the house has more rooms than this.
+MIN_ROOMS_FOR_POOL = 2
+
+# Number of threads writing preview sketches in the background.
+SKETCH_THREADS = 4
+
+# Directory within the output directory that keeps previews of earlier runs.
+PREVIEW_CACHE_DIR = ".cache"
+
+# File within the output directory recording the inputs and outputs of the last run. Used to skip up to date runs.
+STAMP_FILE = ".convert.stamp"
+
+# (conf, house) inherited by forked room export workers.
+_worker_context = None
 
 
 def run(conf: ConfigManager, source, output_path, scale_factor, save_previews,
         save_room_json, skip_objects=False, adjust_short_walls=False,
-        classify_doors_and_windows=False, skip_rdr=False, r2v_annot=False):
+        classify_doors_and_windows=False, skip_rdr=False, r2v_annot=False, num_workers=1, cache_previews=False,
+        compact_json=False, skip_objectaabb=False, skip_up_to_date=False):
     """
     Converts Raster-to-Vector output/annotation to scene.json format.
+    :param num_workers: Number of processes used to save rooms. Rooms are saved in the current process when 1.
+    :param cache_previews: Specify true to keep previews in the output directory, keyed by the inputs. Later runs on the same inputs copy them
+    instead of sketching again.
+    :param compact_json: Specify true to save json files without indentation.
+    :param skip_objectaabb: Specify true to not save the objectaabb.json file.
+    :param skip_up_to_date: Specify true to return early if an earlier run with the same inputs saved outputs that still exist.
+    :return: Converted house. None if the run is skipped.
     """
+    inputs_key = None
+    stamp_path = os.path.join(output_path, STAMP_FILE)
+    if skip_up_to_date:
+        # The scene id and output file names derive from the source path, so the path is part of the key as well as the file contents.
+        inputs_key = _hash_inputs(source, [conf.parser_config, conf.arch_defaults, conf.room_types, conf.data_paths], os.path.abspath(source),
+                                  scale_factor, save_previews, save_room_json, skip_objects, adjust_short_walls, classify_doors_and_windows,
+                                  skip_rdr, r2v_annot, compact_json, skip_objectaabb)
+        if _is_up_to_date(stamp_path, inputs_key):
+            logging.info("Outputs at %s are up to date", output_path)
+            return None
+    if os.path.exists(stamp_path):
+        # Outputs are about to be overwritten, so the stamp of an earlier run no longer holds.
+        os.remove(stamp_path)
+
+    split_walls_enabled = conf.parser_config.split_walls.enabled
+    straighten_walls_enabled = conf.parser_config.straighten_walls.enabled
 
     house = House()
 
@@ -26,14 +72,14 @@ def run(conf: ConfigManager, source, output_path, scale_factor, save_previews,
         house.load_r2v_output_file(conf, source)
 
     # Split walls that intersect with other walls into separate wall segments.
-    if conf.parser_config.split_walls.enabled:
+    if split_walls_enabled:
         house.split_source_walls(conf)
 
     # Generate wall linkage graph and detect rooms.
     house.generate_wall_graph(conf)
 
     # Axis align nearly axis aligned walls.
-    if conf.parser_config.straighten_walls.enabled:
+    if straighten_walls_enabled:
         house.straighten_walls(conf)
 
     # Assign annotation AABBs to rooms
@@ -57,46 +103,189 @@ def run(conf: ConfigManager, source, output_path, scale_factor, save_previews,
     if not skip_rdr:
         house.compute_rdr()
 
-    # Save preview sketches
+    # Reuse previews of an earlier run with the same inputs
+    preview_cache_dir = None
+    preview_files = ["raw_annot.png", "wall_mask.svg"] + [f"room_{i}.png" for i in range(len(house.ordered_rooms))]
+    saved_paths = [os.path.join(output_path, f) for f in preview_files] if save_previews else []
+    if save_previews and cache_previews:
+        cache_key = _hash_inputs(source, [conf.parser_config, conf.room_types, conf.data_paths], scale_factor, skip_objects,
+                                 classify_doors_and_windows, skip_rdr, r2v_annot)
+        preview_cache_dir = os.path.join(output_path, PREVIEW_CACHE_DIR, cache_key)
+        if all(os.path.exists(os.path.join(preview_cache_dir, f)) for f in preview_files):
+            for f in preview_files:
+                shutil.copyfile(os.path.join(preview_cache_dir, f), os.path.join(output_path, f))
+            logging.info("Copied previews from %s", preview_cache_dir)
+            save_previews = False
+            preview_cache_dir = None
+
+    # Save wall mask
     if save_previews:
-        house.sketch_raw_annotations(conf, os.path.join(output_path, "raw_annot.png"))
-        logging.info("Saved {file}".format(file=os.path.join(output_path, "raw_annot.png")))
-
-        # Save wall mask
         wall_mask = house.get_wall_mask()
-        with open(os.path.join(output_path, "wall_mask.svg"), 'w') as f:
+        save_path = os.path.join(output_path, "wall_mask.svg")
+        with open(save_path, 'w') as f:
             f.write(wall_mask._repr_svg_())
+        logging.info("Saved %s", save_path)
 
     # Save room level results
-    for i, room_key in enumerate(house.ordered_rooms):
+    room_args = [(i, room_key, output_path, save_previews, save_room_json, adjust_short_walls, compact_json)
+                 for i, room_key in enumerate(house.ordered_rooms)]
+    mp_context = _get_fork_context()
+    sketch_pool = None
+    sketch_futures = []
+    if (save_previews or save_room_json) and mp_context is not None and num_workers > 1 and len(room_args) > MIN_ROOMS_FOR_POOL:
+        # Workers are forked, so they inherit the house instead of unpickling it. Ids are allocated up front so that every worker agrees on them.
+        if save_room_json:
+            house.allocate_element_ids()
+        global _worker_context
+        _worker_context = (conf, house)
+        try:
+            with ProcessPoolExecutor(max_workers=min(num_workers, len(room_args)), mp_context=mp_context) as pool:
+                # Room keys hash by wall identity, so only the room index is sent to workers.
+                futures = [pool.submit(_save_room_in_worker, a[0], *a[2:]) for a in room_args]
+                room_jsons = [future.result() for future in futures]
+        finally:
+            _worker_context = None
+    else:
+        # Room sketches are saved from background threads, which PIL releases the GIL for while encoding.
+        # The room jsons are generated in the meantime.
         if save_previews:
-            house.sketch_room_annotations(conf, room_key, os.path.join(output_path, "room_" + str(i) + ".png"))
-            logging.info("Saved {file}".format(file=os.path.join(output_path, "room_" + str(i) + ".png")))
-
+            sketch_pool = ThreadPoolExecutor(max_workers=SKETCH_THREADS)
+            sketch_futures.extend(sketch_pool.submit(_save_sketch, house.sketch_room_annotations, conf, room_key,
+                                                     path=os.path.join(output_path, f"room_{i}.png"))
+                                  for i, room_key in enumerate(house.ordered_rooms))
+        # Sketches are already queued, so only the room jsons are left to save.
+        room_jsons = []
         if save_room_json:
-            room_json = house.get_room_json(conf, room_key, True, [], adjust_short_walls=adjust_short_walls)[0]
-
-            with open(os.path.join(output_path, room_json["id"] + ".arch.json"), "w") as f:
-                f.write(json.dumps(room_json, indent=3))
-            logging.info("Saved {file}".format(file=os.path.join(output_path, "room_" + str(i) + ".json")))
+            room_jsons = [save_room(conf, house, i, room_key, output_path, False, True, adjust_short_walls, compact_json)
+                          for i, room_key, *_ in room_args]
+    saved_paths.extend(os.path.join(output_path, room_json["id"] + ".arch.json") for room_json in room_jsons if room_json is not None)
+    # Room jsons are reused by the scene.json
+    precomputed_rooms = {room_key: room_json for room_key, room_json in zip(house.ordered_rooms, room_jsons) if room_json is not None}
+
+    # Save preview sketch of the raw annotations in the background.
+    # Threads are only started once the room workers are done, since forking a process that runs threads is unsafe.
+    if save_previews:
+        if sketch_pool is None:
+            sketch_pool = ThreadPoolExecutor(max_workers=SKETCH_THREADS)
+        sketch_futures.append(sketch_pool.submit(_save_sketch, house.sketch_raw_annotations, conf, path=os.path.join(output_path, "raw_annot.png")))
 
     # Save scene.json
-    scene_json = house.get_scene_json(conf, adjust_short_walls=adjust_short_walls)
+    scene_json = house.get_scene_json(conf, adjust_short_walls=adjust_short_walls, precomputed_rooms=precomputed_rooms)
     save_path = os.path.join(output_path, scene_json["scene"]["arch"]["id"] + ".scene.json")
-    with open(save_path, "w") as f:
-        f.write(json.dumps(scene_json, indent=3))
-    logging.info("Saved {file}".format(file=save_path))
+    save_json(scene_json, save_path, pretty=not compact_json)
+    saved_paths.append(save_path)
+    logging.info("Saved %s", save_path)
 
     # Save objectaabb.json
-    object_aabb_json = house.get_objectaabb_json(conf)
-    save_path = os.path.join(output_path, scene_json["scene"]["arch"]["id"] + ".objectaabb.json")
-    with open(save_path, "w") as f:
-        f.write(json.dumps(object_aabb_json, indent=3))
-
-    logging.info("Saved {file}".format(file=save_path))
+    if not skip_objectaabb:
+        object_aabb_json = house.get_objectaabb_json(conf)
+        save_path = os.path.join(output_path, scene_json["scene"]["arch"]["id"] + ".objectaabb.json")
+        save_json(object_aabb_json, save_path, pretty=not compact_json)
+        saved_paths.append(save_path)
+        logging.info("Saved %s", save_path)
+
+    if sketch_pool is not None:
+        for future in sketch_futures:
+            future.result()
+        sketch_pool.shutdown()
+
+    if preview_cache_dir is not None:
+        # Only the latest entry is kept, so the cache does not grow with every change of inputs.
+        shutil.rmtree(os.path.dirname(preview_cache_dir), ignore_errors=True)
+        os.makedirs(preview_cache_dir)
+        for f in preview_files:
+            shutil.copyfile(os.path.join(output_path, f), os.path.join(preview_cache_dir, f))
+        logging.info("Cached previews at %s", preview_cache_dir)
+
+    if skip_up_to_date:
+        save_json({"inputs": inputs_key, "outputs": saved_paths}, stamp_path)
     return house
 
 
+def save_room(conf: ConfigManager, house: House, i: int, room_key, output_path, save_previews, save_room_json, adjust_short_walls=False,
+              compact_json=False):
+    """
+    Save the preview sketch and the arch.json of a room.
+    :param conf: ConfigManager
+    :param house: House
+    :param i: Index of the room in house.ordered_rooms
+    :param room_key: Key of the room
+    :return: The arch.json of the room if save_room_json is set. Otherwise None.
+    """
+    if save_previews:
+        save_path = os.path.join(output_path, f"room_{i}.png")
+        house.sketch_room_annotations(conf, room_key, save_path)
+        logging.info("Saved %s", save_path)
+
+    if save_room_json:
+        room_json = house.get_room_json(conf, room_key, True, [], adjust_short_walls=adjust_short_walls, return_extras=False)
+
+        save_path = os.path.join(output_path, room_json["id"] + ".arch.json")
+        save_json(room_json, save_path, pretty=not compact_json)
+        logging.info("Saved %s", save_path)
+        return room_json
+    return None
+
+
+def _save_sketch(sketch, conf: ConfigManager, *args, path: str) -> None:
+    """
+    Save a preview sketch using one of the House.sketch_* methods.
+    """
+    sketch(conf, *args, path)
+    logging.info("Saved %s", path)
+
+
+def _save_room_in_worker(i: int, *args):
+    conf, house = _worker_context
+    return save_room(conf, house, i, house.ordered_rooms[i], *args)
+
+
+def _hash_inputs(source: str, configs: list, *args) -> str:
+    """
+    Hash of the source file, the given configurations and the given run arguments.
+    """
+    def config_state(value):
+        # Read Config attributes rather than config_dict, since attributes may have been overridden after loading.
+        if isinstance(value, Config):
+            return {k: config_state(v) for k, v in value.__dict__.items() if k != "config_dict"}
+        if isinstance(value, list):
+            return [config_state(v) for v in value]
+        return value
+
+    h = hashlib.blake2b(digest_size=16)
+    with open(source, "rb") as f:
+        h.update(f.read())
+    state = [args, config_state(configs)]
+    h.update(json.dumps(state, sort_keys=True, default=str).encode("utf-8"))
+    return h.hexdigest()
+
+
+def _is_up_to_date(stamp_path: str, inputs_key: str) -> bool:
+    """
+    Check whether the last run saved its stamp with the same inputs, and all of its outputs still exist.
+    """
+    if not os.path.exists(stamp_path):
+        return False
+    try:
+        with open(stamp_path) as f:
+            stamp = json.load(f)
+        stamp_inputs, stamp_outputs = stamp["inputs"], stamp["outputs"]
+    except (ValueError, KeyError, TypeError):
+        logging.warning("Ignoring unreadable stamp %s", stamp_path)
+        return False
+    return stamp_inputs == inputs_key and all(os.path.exists(path) for path in stamp_outputs)
+
+
+def _get_fork_context():
+    """
+    Multiprocessing context that forks workers, or None if fork is unavailable on this platform.
+    """
+    try:
+        return multiprocessing.get_context("fork")
+    except ValueError:
+        return None
+
+
 def run_args(conf: ConfigManager, args):
     """
     Process command line args.
@@ -110,7 +299,8 @@ def run_args(conf: ConfigManager, args):
                 scale_factor=args.scale_factor[0], skip_objects=args.skip_objects,
                 adjust_short_walls=not args.do_not_adjust_short_walls,
                 classify_doors_and_windows=not args.do_not_classify_doors_and_windows,
-                skip_rdr=args.skip_rdr, r2v_annot=args.r2v_annot)
+                skip_rdr=args.skip_rdr, r2v_annot=args.r2v_annot, num_workers=args.num_workers, cache_previews=args.cache_previews,
+                compact_json=args.compact_json, skip_objectaabb=args.skip_objectaabb, skip_up_to_date=args.skip_up_to_date)
 
     return house
 
@@ -131,10 +321,15 @@ def add_args(parser: argparse.ArgumentParser) -> None:
 
     parser.add_argument("--no-previews", default=False, action="store_true",
                         help="Don't generate PNG previews")
+    parser.add_argument("--cache-previews", default=False, action="store_true",
+                        help="Keep previews under " + PREVIEW_CACHE_DIR + " of the output directory and reuse them on later runs with the same inputs.")
 
     parser.add_argument("--room-json", default=False, action="store_true",
                         help="Generate individual room's json")
 
+    parser.add_argument("--compact-json", default=False, action="store_true",
+                        help="Save json files without indentation. Smaller and faster to write.")
+
     parser.add_argument("--skip-objects", default=False, action="store_true",
                         help="Don't place objects")
 
@@ -143,13 +338,45 @@ def add_args(parser: argparse.ArgumentParser) -> None:
     parser.add_argument("--do-not-classify-doors-and-windows", default=False, action="store_true",
                         help="Don't classify holes as doors or windows")
     parser.add_argument("--skip-rdr", default=False, action="store_true", help="Avoid computing RDR edges.")
+    parser.add_argument("--skip-objectaabb", default=False, action="store_true", help="Don't save the objectaabb.json file.")
+    parser.add_argument("--skip-up-to-date", default=False, action="store_true",
+                        help="Skip the conversion if an earlier run with the same inputs saved outputs that still exist.")
+    parser.add_argument("--num-workers", type=int, default=1,
+                        help="Number of processes used to save rooms. Defaults to 1, which saves rooms in the current process.")
 
 
-if __name__ == "__main__":
+def run_batch(conf: ConfigManager, sources: list, output_paths: list, **kwargs) -> list:
+    """
+    Convert several Raster-to-Vector outputs/annotations with a single ConfigManager. Avoids the interpreter start up and config parsing
+    that running convert.py once per file costs.
+    :param conf: ConfigManager
+    :param sources: Paths to the files to convert.
+    :param output_paths: Output directory of each source. Created if missing.
+    :param kwargs: Other arguments of run.
+    :return: List of converted houses.
+    """
+    assert len(sources) == len(output_paths)
+    houses = []
+    for source, output_path in zip(sources, output_paths):
+        os.makedirs(output_path, exist_ok=True)
+        houses.append(run(conf, source, output_path, **kwargs))
+    return houses
+
+
+def main(argv: list = None) -> House:
+    """
+    Command line entry point.
+    :param argv: Command line arguments. Read from sys.argv if not specified.
+    :return: Converted house.
+    """
     conf = ConfigManager()
     parser = argparse.ArgumentParser(description='Generate scene-toolkit compatible json files.')
     conf.add_args(parser)
     add_args(parser)
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     conf.process_args(args, output_is_dir=True)
-    run_args(conf, args)
+    return run_args(conf, args)
+
+
+if __name__ == "__main__":
+    main()